@@ -5,14 +5,29 @@ Created on Wed Mar 06 12:31:00 2024
 @author: ljr1e21
 """
 
+import io
 import os
-import fnmatch as fnm
+import re
+import mmap
+import time
 import numpy as np
 import trimesh as tr
-from dataclasses import dataclass
+from dataclasses import dataclass, field, fields
 from abc import ABC, abstractmethod
+from HexMeshMorpher import inp_cache, stl_io
+from HexMeshMorpher.container import write_container, read_container
 
 FOLDER = 'Geometry'
+# File type of the meshes saved by TriMesh.save_mesh_container
+MESH_TYPE = 'mesh'
+# Keyword lines of an inp file start with a single *, comments with **
+KEYWORD_PATTERN = re.compile(rb'^\*(?!\*)[^\n]*', re.MULTILINE)
+# Data lines split at the 16 item limit end with a comma
+CONTINUATION_PATTERN = re.compile(rb',[ \t]*\r?\n')
+# Data lines of an inp file begin with a number
+DATA_PATTERN = re.compile(rb'[ \t]*[-+]?\d')
+# Line of the node block, %r of a float matches the f-string formatting
+NODE_FORMAT = '%7d,  %11r,  %11r,  %11r\n'
 
 
 @dataclass
@@ -29,6 +44,42 @@ class Boundary():
     corner_node_angle_threshold: float = None
     interpollation_coords: np.ndarray = None
     interpollation_num: np.ndarray = None
+    loops: list = None
+
+
+@dataclass
+class NodeSection():
+    """ A *Node block of an inp file, rows start:stop of INPMesh.nodes. """
+    head: str
+    part: str = None
+    start: int = 0
+    stop: int = 0
+
+
+@dataclass
+class ElementSection():
+    """ An *Element block of an inp file, all of one element type. """
+    head: str
+    elements: np.ndarray = None
+    part: str = None
+
+    @property
+    def element_type(self) -> str:
+        return keyword_options(self.head).get('type')
+
+
+@dataclass
+class Part():
+    """
+    The sections and sets of a *Part of an inp file. The model data outside
+    of any part is held in a Part with no name.
+    """
+    name: str = None
+    head: str = None
+    node_sections: list = field(default_factory=list)
+    element_sections: list = field(default_factory=list)
+    node_sets: dict = field(default_factory=dict)
+    element_sets: dict = field(default_factory=dict)
 
 
 class Mesh(ABC):
@@ -49,6 +100,7 @@ class Mesh(ABC):
         self.unit_factor = 1.0
 
         self.nodes: np.ndarray = None
+        self._bounds: np.ndarray = None
 
     def path(self, file_name: str = None, file_type: str = None):
         """
@@ -91,6 +143,44 @@ class Mesh(ABC):
     @abstractmethod
     def scale_mesh(self, factor) -> None:
         raise NotImplementedError
+
+    @property
+    def coordinates(self) -> np.ndarray:
+        """The (n, 3) array of the coordinates of the nodes."""
+        return self.nodes[:, 1:]
+
+    @property
+    def bounds(self) -> np.ndarray:
+        """
+        The minimum and maximum coordinates of the mesh as a (2, 3) array.
+        It is cached until the nodes are changed through the methods of the
+        mesh, call invalidate_bounds after editing the nodes directly.
+        """
+        if self._bounds is None:
+            coords = self.coordinates
+            self._bounds = np.array([coords.min(axis=0), coords.max(axis=0)])
+        return self._bounds
+
+    def invalidate_bounds(self) -> None:
+        self._bounds = None
+
+    def detect_units(self) -> None:
+        """ Sets the units from the width of the mesh in the x axis. """
+        x_range = self.bounds[1, 0] - self.bounds[0, 0]
+        # Not very good way of doing this assumes meters if the mesh is smaller than one in its width in the x axis and otherwise assumes millimeters
+        if abs(x_range) > 1:
+            self.set_units("mm")
+        else:
+            self.set_units("m")
+
+    def get_bounding_box(self) -> list:
+        """
+        Gets the xyz values of the centroid, range, maximum and minumum.
+        """
+        minimums, maximums = self.bounds
+        centroid = (maximums + minimums)/2
+        difference = maximums - minimums
+        return centroid.tolist(), difference.tolist(), maximums.tolist(), minimums.tolist()
     
     @staticmethod
     def calculate_angle(nodes):
@@ -100,14 +190,16 @@ class Mesh(ABC):
             iterable of nodes with coordinates [[x1, y1, z1],
                                                 [x2, y2, z2],
                                                 [x3, y3, z3]]
-            where the angle 1-2-3 is then found.
-        """
-        v1 = [a_i - b_i for a_i, b_i in zip(nodes[0], nodes[1])]
-        v2 = [a_i - b_i for a_i, b_i in zip(nodes[2], nodes[1])]
-        dot = np.dot(v1, v2)
-        v1_mag = np.linalg.norm(v1)
-        v2_mag = np.linalg.norm(v2)
-        angle = np.arccos(dot/(v1_mag*v2_mag))
+            where the angle 1-2-3 is then found. Arrays of shape (3, n, 3)
+            give the n angles of n triples of nodes at once.
+        """
+        nodes = np.asarray(nodes, dtype=np.float64)
+        v1 = nodes[0] - nodes[1]
+        v2 = nodes[2] - nodes[1]
+        dot = np.sum(v1 * v2, axis=-1)
+        v1_mag = np.linalg.norm(v1, axis=-1)
+        v2_mag = np.linalg.norm(v2, axis=-1)
+        angle = np.arccos(np.clip(dot/(v1_mag*v2_mag), -1.0, 1.0))
         return angle
 
 
@@ -118,6 +210,88 @@ class Mesh(ABC):
 # trimesh.transformations.scale_and_translate(scale=None, translate=None)
 
 
+class NodeView(np.lib.mixins.NDArrayOperatorsMixin):
+    """
+    View of the vertices of a trimesh laid out as (index, x, y, z) rows.
+    Indexing the coordinate columns returns the trimesh vertices themselves,
+    without a copy, and the index column is generated when it is used.
+    Selecting rows only builds those rows, anything else (iteration,
+    arithmetic, numpy functions) is done on the full array, built on demand.
+    """
+
+    ndim = 2
+    dtype = np.dtype(np.float64)
+
+    def __init__(self, trimesh: tr.Trimesh) -> None:
+        self.trimesh = trimesh
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self.trimesh.vertices), 4)
+
+    @property
+    def T(self) -> np.ndarray:
+        return np.asarray(self).T
+
+    def __len__(self) -> int:
+        return len(self.trimesh.vertices)
+
+    def __iter__(self):
+        return iter(np.asarray(self))
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        return self._rows(slice(None), dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = [np.asarray(item) if isinstance(item, NodeView) else item
+                  for item in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def copy(self) -> np.ndarray:
+        """Returns the nodes as a new (n, 4) array."""
+        return np.asarray(self)
+
+    def _rows(self, rows, dtype=None) -> np.ndarray:
+        """Builds the (index, x, y, z) rows selected by rows."""
+        vertices = self.trimesh.vertices[rows]
+        nodes = np.empty(vertices.shape[:-1] + (4,), dtype=dtype or np.float64)
+        nodes[..., 0] = np.arange(len(self), dtype=np.float64)[rows]
+        nodes[..., 1:] = vertices
+        return nodes
+
+    def _columns(self, key):
+        """Splits key into rows and columns if it only selects coordinates."""
+        if not isinstance(key, tuple) or len(key) != 2:
+            return None
+        rows, columns = key
+        if isinstance(columns, slice) and columns.step in (None, 1) \
+                and columns.start is not None and columns.start > 0:
+            return rows, slice(columns.start - 1,
+                               None if columns.stop is None else columns.stop - 1)
+        if isinstance(columns, (int, np.integer)) and columns > 0:
+            return rows, columns - 1
+        return None
+
+    def __getitem__(self, key):
+        columns = self._columns(key)
+        if columns is not None:
+            return self.trimesh.vertices[columns]
+        if isinstance(key, tuple) and len(key) == 2 \
+                and isinstance(key[1], (int, np.integer)) and key[1] == 0:
+            return np.arange(len(self), dtype=np.float64)[key[0]]
+        if not isinstance(key, tuple):
+            return self._rows(key)
+        if len(key) == 2 and key[0] is not None and key[0] is not Ellipsis:
+            return self._rows(key[0])[..., key[1]]
+        return np.asarray(self)[key]
+
+    def __setitem__(self, key, value):
+        columns = self._columns(key)
+        if columns is None:
+            raise IndexError("Only the coordinates of the nodes can be set.")
+        self.trimesh.vertices[columns] = value
+
+
 class TriMesh(Mesh):
     """Class for defining file names and locations where they are saved"""
 
@@ -139,68 +313,139 @@ class TriMesh(Mesh):
         )
 
         self.trimesh = None
+        self._bounds_key = None
 
         if load:
             self.load_mesh()
 
     def load_mesh(self):
-        self.load_stl()
+        if self.f_type.lower() == MESH_TYPE:
+            self.load_mesh_container()
+        else:
+            self.load_stl()
 
     def load_stl(self) -> None:
         """Loads STL file as trimesh object."""
-        self.trimesh: tr.Trimesh = tr.load_mesh(self.path())
-        self.nodes = np.array(
-            [[i, vertex[0], vertex[1], vertex[2]]
-             for i, vertex in enumerate(self.trimesh.vertices)]
-            )
+        if self.f_type.lower() == 'stl':
+            self.trimesh: tr.Trimesh = stl_io.load_stl(self.path())
+        else:
+            self.trimesh: tr.Trimesh = tr.load_mesh(self.path())
         self.num_nodes = len(self.trimesh.vertices)
         self.num_elements = len(self.trimesh.faces)
-        x1 = np.max(self.trimesh.vertices[:][0])
-        x2 = np.min(self.trimesh.vertices[:][0])
-        # Not very good way of doing this assumes meters if the mesh is smaller than one in its width in the x axis and otherwise assumes millimeters
-        if abs(x1 - x2) > 1:
-            self.set_units("mm")
-        else:
-            self.set_units("m")
+        self.detect_units()
 
     def update_nodes(self, nodes):
-        for i, node in enumerate(nodes):
-            for j, coord in enumerate(node):
-                self.nodes[i, j+1] = coord
+        """Sets the coordinates of the nodes, in place of the old ones."""
         self.trimesh.vertices = nodes
 
-    def save_mesh(self, file_path):
-        self.save_trimesh_as_stl(file_path=file_path)
+    @property
+    def nodes(self):
+        """
+        The nodes as (index, x, y, z) rows like INPMesh.nodes. This is a
+        NodeView of the trimesh vertices, so it is never out of date and is
+        only built into an array if it is asked for as one.
+        """
+        if self.trimesh is None:
+            return None
+        return NodeView(self.trimesh)
+
+    @nodes.setter
+    def nodes(self, nodes):
+        if nodes is not None:
+            self.trimesh.vertices = np.asarray(nodes)[:, 1:]
 
-    def save_trimesh_as_stl(self, name=None, file_path=None) -> None:
-        """Saves trimesh object as an STL."""
+    @property
+    def coordinates(self) -> np.ndarray:
+        return self.trimesh.vertices
+
+    @property
+    def bounds(self) -> np.ndarray:
+        """
+        The bounds of the vertices, cached until the hash trimesh keeps of
+        its vertices changes.
+        """
+        vertices = self.trimesh.vertices
+        key = hash(vertices)
+        if self._bounds is None or self._bounds_key != key:
+            self._bounds = np.array([vertices.min(axis=0), vertices.max(axis=0)])
+            self._bounds_key = key
+        return self._bounds
+
+    def save_mesh(self, file_path, binary: bool = True):
+        self.save_trimesh_as_stl(file_path=file_path, binary=binary)
+
+    def save_trimesh_as_stl(self, name=None, file_path=None,
+                            binary: bool = True) -> None:
+        """Saves trimesh object as an STL, binary unless binary is False."""
         if file_path:
             f_path = file_path
         elif name:
             f_path = self.path(name)
-        self.trimesh.export(file_obj=f_path, file_type='stl_ascii')
+        stl_io.write_stl(f_path, self.trimesh.triangles, binary=binary,
+                         name=self.name)
         print(f"File successfully saved as {f_path}")
 
-    def save_trimesh_as_npy(self) -> None:
+    def save_mesh_container(self, file_path: str = None,
+                            use_float32: bool = False) -> None:
         """
-        A function that saves a trimeshe's vertices and faces in npy files.
-        This was implemented before the STL saving feature. It may still be
-        useful in some instances, so it will be left here.
+        Saves the vertices, faces, units and boundary of the mesh in a single
+        container file, by default self.f_path with the .mesh extension.
+        The faces are stored with the smallest unsigned integer type that
+        holds them and the vertices as float32 if use_float32 is True.
         """
-        vertices = self.trimesh.vertices
-        faces = self.trimesh.faces
-        np.save("vert_" + self.f_name, vertices)
-        np.save("faces_" + self.f_name, faces)
+        f_path = file_path if file_path else self.path(file_type=MESH_TYPE)
+        vertices = np.asarray(self.trimesh.vertices)
+        faces = np.asarray(self.trimesh.faces)
+        arrays = {
+            'vertices': vertices.astype(np.float32 if use_float32 else np.float64),
+            'faces': faces.astype(smallest_uint(len(vertices))),
+        }
+        boundary_meta = {}
+        for item in fields(Boundary):
+            value = getattr(self.boundary, item.name)
+            if isinstance(value, np.ndarray):
+                arrays[f'boundary.{item.name}'] = value
+            elif item.name == 'loops' and value is not None:
+                boundary_meta['num_loops'] = len(value)
+                for i, loop in enumerate(value):
+                    arrays[f'boundary.loops.{i}'] = loop
+            elif value is not None:
+                boundary_meta[item.name] = np.asarray(value).tolist()
+        meta = {
+            'name': self.name,
+            'description': self.description,
+            'units': self.units,
+            'boundary': boundary_meta,
+        }
+        write_container(f_path, meta, arrays)
+        print(f"File successfully saved as {f_path}")
 
-    def load_trimesh_from_npy(self) -> None:
+    def load_mesh_container(self, file_path: str = None,
+                            mmap_mode: str = None) -> None:
         """
-        A function to load trimeshes meshes that have been saved as npy files.
+        Loads a mesh saved by save_mesh_container. The trimesh is created
+        without processing, so the vertices and faces are used as saved.
+        With mmap_mode ('r' or 'c') the arrays are memory-mapped.
         """
-        print("LOADING: " + self.f_name)
-        loaded_vertices = np.load("vert_" + self.f_name)
-        loaded_faces = np.load("faces_" + self.f_name)
-        self.trimesh = tr.Trimesh(loaded_vertices, loaded_faces)
-        print("LOADED: " + self.f_name)
+        f_path = file_path if file_path else self.path(file_type=MESH_TYPE)
+        meta, arrays = read_container(f_path, mmap_mode=mmap_mode)
+        self.trimesh = tr.Trimesh(vertices=arrays['vertices'],
+                                  faces=arrays['faces'], process=False)
+        self.num_nodes = len(self.trimesh.vertices)
+        self.num_elements = len(self.trimesh.faces)
+        self.description = meta['description']
+        self.set_units(meta['units'])
+
+        boundary_meta = meta['boundary']
+        self.boundary = Boundary()
+        for item in fields(Boundary):
+            if f'boundary.{item.name}' in arrays:
+                setattr(self.boundary, item.name, arrays[f'boundary.{item.name}'])
+            elif item.name in boundary_meta:
+                setattr(self.boundary, item.name, boundary_meta[item.name])
+        if 'num_loops' in boundary_meta:
+            self.boundary.loops = [arrays[f'boundary.loops.{i}']
+                                   for i in range(boundary_meta['num_loops'])]
 
     def apply_transformation(self, t_matrix) -> None:
         """Apply transformation matrix to the trimesh object"""
@@ -224,11 +469,6 @@ class TriMesh(Mesh):
         assert not self.trimesh.is_watertight, (
             "This mesh has no holes, so rim cannot be found."
             )
-        assert self.trimesh.euler_number == 1, (
-            "The mesh has more than one openning so a unique rim cannot be"
-            f"found.\n\tEuler number = {self.trimesh.euler_number}"
-            f"\n\tMesh contains {1-self.trimesh.euler_number} holes."
-            )
         unique_edges = self.trimesh.edges[
             tr.grouping.group_rows(self.trimesh.edges_sorted, require_count=1)
         ]
@@ -248,29 +488,22 @@ class TriMesh(Mesh):
         self.arrange_boundary_nodes()
 
     def arrange_boundary_edges(self) -> np.ndarray:
-        """ Edges are stored in a nx2 numpy array. """
+        """
+        Edges are stored in a nx2 numpy array. The boundary edges are chained
+        into loops, each ordered so that every edge starts at the end of the
+        previous one. All the loops are kept in self.boundary.loops, longest
+        first, and the longest is used as the boundary.
+        """
         if self.boundary.edges is None:
             self.get_boundary()
-        boundary_edges = self.boundary.edges
-
-        unsorted_edges = [[item for item in row] for row in boundary_edges]
-        sorted_edges = np.zeros(np.shape(boundary_edges), dtype=np.uint32)
-
-        sorted_edges[0, :] = boundary_edges[0, :]
-        del unsorted_edges[0]
-        index = 1
-        while len(unsorted_edges) > 0:
-            for edge in unsorted_edges:
-                if sorted_edges[index-1, 1] in edge:
-                    if edge[1] == sorted_edges[index-1, 1]:
-                        e = reversed(edge)
-                    else:
-                        e = edge
-                    for i, node_index in enumerate(e):
-                        sorted_edges[index, i] = node_index
-                    unsorted_edges.remove(edge)
-                    index += 1
-                    break
+        loops = [loop.astype(np.uint32)
+                 for loop in order_boundary_loops(self.boundary.edges)]
+        if len(loops) > 1:
+            print(f"The mesh has {len(loops)} boundary loops, using the longest"
+                  f" with {len(loops[0])} edges.")
+        sorted_edges = loops[0]
+        self.boundary.loops = loops
+        self.boundary.nodes = np.unique(sorted_edges)
         self.boundary.edges = sorted_edges
         self.boundary.edges_sorted = True
         return sorted_edges
@@ -279,10 +512,9 @@ class TriMesh(Mesh):
         """ Arranges the nodes array to match the ordered list of edges. """
         if not self.boundary.edges_sorted:
             self.arrange_boundary_edges()
-        sorted_nodes = np.zeros(np.shape(self.boundary.nodes), dtype=np.uint32)
-        for i, edge in enumerate(self.boundary.edges):
-            sorted_nodes[i] = int(edge[0])
-        assert set(sorted_nodes) == set(self.boundary.nodes), (
+        sorted_nodes = self.boundary.edges[:, 0].astype(np.uint32)
+        assert len(sorted_nodes) == len(self.boundary.nodes) and \
+            np.array_equal(np.unique(sorted_nodes), self.boundary.nodes), (
             "Error in sorting nodes."
             )
         self.boundary.nodes = sorted_nodes
@@ -290,15 +522,16 @@ class TriMesh(Mesh):
         self.boundary.nodes = self.restarted_arranged_nodes()
         return sorted_nodes
 
-    def get_boundary_faces(self) -> list:
-        """ Finds all the faces that have edges along the boundary. """
+    def get_boundary_faces(self) -> np.ndarray:
+        """
+        Finds all the faces that have a node on the boundary, returning
+        their indices in ascending order.
+        """
         if self.boundary.nodes is None:
             self.get_boundary()
-        boundary_faces = []
-        for i, face in enumerate(self.trimesh.faces):
-            for item in face:
-                if item in self.boundary.nodes and i not in boundary_faces:
-                    boundary_faces.append(i)
+        on_boundary = np.zeros(len(self.trimesh.vertices), dtype=bool)
+        on_boundary[self.boundary.nodes] = True
+        boundary_faces = np.flatnonzero(on_boundary[self.trimesh.faces].any(axis=1))
         self.boundary.faces = boundary_faces
         return boundary_faces
 
@@ -309,15 +542,15 @@ class TriMesh(Mesh):
         if not self.boundary.edges_sorted:
             self.get_boundary()
 
-        corners = []
-        previous_edge = self.boundary.edges[-1]
-        for edge in self.boundary.edges:
-            nodes = [previous_edge[0], edge[0], edge[1]]
-            nodes_coords = [self.trimesh.vertices[i] for i in nodes]
-            angle_rad = self.calculate_angle(nodes_coords)
-            if angle_rad <= angle_threshold*np.pi/180.0:
-                corners.append(edge[0])
-            previous_edge = edge
+        # The angle at the start of each edge, between the previous edge and it
+        edges = self.boundary.edges
+        vertices = self.trimesh.vertices
+        angles = self.calculate_angle(np.stack([
+            vertices[np.roll(edges[:, 0], 1)],
+            vertices[edges[:, 0]],
+            vertices[edges[:, 1]],
+            ]))
+        corners = edges[angles <= angle_threshold*np.pi/180.0, 0].tolist()
         self.boundary.corner_nodes = corners
         self.boundary.corner_node_angle_threshold = angle_threshold
         return corners
@@ -385,47 +618,32 @@ class TriMesh(Mesh):
             self.arrange_boundary()
 
         boundary_nodes = self.restarted_arranged_nodes(ccw_flag=ccw_flag)
-        coords = self.trimesh.vertices[boundary_nodes]
-        coords = np.append(coords, [coords[0]], axis=0)
 
         if self.boundary.corner_nodes and not ignore_corners:
             # TODO: Adjust the nodes number to be representitive of the total
             # number of nodes.
             sub_num_nodes = int(num_nodes/len(self.boundary.corner_nodes))
-            indexes = []
-            for i, boundary_node in enumerate(boundary_nodes):
-                if boundary_node in self.boundary.corner_nodes:
-                    indexes.append(i)
-            indexes.insert(0, 0)
-            indexes.append(-2)
-            coords_list = []
-            for i in range(len(self.boundary.corner_nodes) + 1):
-                limit = [indexes[i], indexes[i+1]]
-                coords_list.append(
-                    self.trimesh.vertices[boundary_nodes[limit[0]:limit[1]+1]]
-                    )
-            coords_list[-1] = np.append(coords_list[-1],
-                                        coords_list[0],
-                                        axis=0)
-            del coords_list[0]
-            interp_array = np.array([[None, None, None]])
-            for coords in coords_list:
-                resampled_points = self.resample_nodes(coords,
-                                                       sub_num_nodes + 1)
-                last_index = len(resampled_points) - 1
-                resampled_points = np.delete(resampled_points, last_index, 0)
-                interp_array = np.concatenate(
-                    (interp_array, resampled_points,),
-                    axis=0
+            # Positions of the corners along the boundary
+            sorter = np.argsort(boundary_nodes)
+            positions = np.sort(sorter[np.searchsorted(
+                boundary_nodes, self.boundary.corner_nodes, sorter=sorter)])
+            # The boundary continued round to the first corner, so that the
+            # last section runs from the last corner to the first
+            closed = np.append(boundary_nodes, boundary_nodes[:positions[0] + 1])
+            limits = np.append(positions, len(boundary_nodes) + positions[0])
+            interp_array = np.empty((len(positions)*sub_num_nodes, 3))
+            for i in range(len(positions)):
+                coords = self.trimesh.vertices[closed[limits[i]:limits[i+1] + 1]]
+                interp_array[i*sub_num_nodes:(i+1)*sub_num_nodes] = (
+                    self.resample_nodes(coords, sub_num_nodes + 1)[:-1]
                     )
 
         else:
             coords = self.trimesh.vertices[boundary_nodes]
             coords = np.append(coords, [coords[0]], axis=0)
-            interp_array = self.resample_nodes(coords, num_nodes + 1)
-            last_index = len(interp_array) - 1
+            interp_array = self.resample_nodes(coords, num_nodes + 1)[:-1]
 
-        self.boundary.interpollation_coords = interp_array[:-1]
+        self.boundary.interpollation_coords = interp_array
         # You should only do this if your edge is very close to the value your a fixing it as.
         # self.boundary.interpollation_coords[:,1] = 360 # This offsets all the landmark coords at the boundary to a specific value. It assumes this is in the zx-plane so fixes y values.
         self.boundary.interpollation_num = num_nodes
@@ -463,22 +681,6 @@ class TriMesh(Mesh):
         """ Scales the mesh by a given factor. """
         self.trimesh.apply_scale(factor)
 
-    def get_bounding_box(self) -> list:
-        """
-        Gets the xyz values of the centroid, range, maximum and minumum.
-        """
-        maximums = [coord for coord in self.trimesh.vertices[0]]
-        minimums = [coord for coord in self.trimesh.vertices[0]]
-        for node in self.trimesh.vertices:
-            for i, coord in enumerate(node[1:]):
-                if coord > maximums[i]:
-                    maximums[i] = coord
-                elif coord < minimums[i]:
-                    minimums[i] = coord
-        centroid = [(maximums[i] + minimums[i])/2 for i in range(3)]
-        difference = [maximums[i] - minimums[i] for i in range(3)]
-        return centroid, difference, maximums, minimums
-
 
 class INPMesh(Mesh):
     """
@@ -491,7 +693,10 @@ class INPMesh(Mesh):
             name: str,
             f_name: str,
             f_folder: str,
-            description: str = None
+            description: str = None,
+            use_cache: bool = False,
+            cache_folder: str = None,
+            cache_size: float = 4096.0
         ) -> None:
         super().__init__(
             name=name,
@@ -504,136 +709,363 @@ class INPMesh(Mesh):
         self.stl_path = self.path(file_type='stl')
 
         # NPY
-        self.elements = None
         self.nodes = None
 
         # INP
-        self._inp_head = []        # Heading for the inp file
         self.part_head = []       # Heading for the part
-        self.elem_head = []       # Heading for the elements i.e. type
-        self._inp_tail = []        # Tail for the inp file
+        self.parts = []           # Parts of the inp file
+        # The file as a list of node and element sections and the lists of
+        # lines of text between them
+        self.segments = []
 
         self.boundary_nodes = []
         self.num_boundary_nodes = None
         self.boundary_nodes_path = None
 
+        # Cache of the parsed file, see inp_cache
+        self.use_cache = use_cache
+        self.cache_folder = cache_folder
+        self.cache_size = cache_size  # MB
+
         self.load_mesh()
 
     def load_mesh(self):
+        if self.use_cache and self.load_cached_inp():
+            return
         self.read_inp()
+        if self.use_cache:
+            self.save_cached_inp()
 
-    def read_inp(self):
-        """ Reads data from an ascii encoded inp file to the INPMesh object."""
-        data_list = []
-        with open(self.f_path, 'r', encoding="utf-8") as file:
-            data_list = file.readlines()
-        try:
-            [indexes, instances] = self.find_index(data_list, '*Part,')
-            assert len(indexes) == 1, (
-                f"Can only process inp files with one part, {len(indexes)} "
-                "were given."
-                )
-            part_index = indexes[0]
-            self.part_head = instances[0].strip()
-            self.part_name = instances[0].split('=')[-1].strip()
-        except:
-            print("No *PART found, contining without parts")
-
-        [n_indexes, n_insts] = self.find_index(data_list, '*Node')
-        assert len(n_indexes) == 1, (
-            "Can only process inp files with one node section, "
-            f"{len(n_indexes)} are given."
+    def load_cached_inp(self) -> bool:
+        """
+        Loads the mesh from the inp cache, with the nodes and elements
+        memory-mapped from the cache file. Returns False if the file has no
+        valid cache entry.
+        """
+        start_time = time.time()
+        cached = inp_cache.load(self.f_path, self.cache_folder)
+        if cached is None:
+            return False
+        meta, arrays = cached
+        self.nodes = arrays['nodes']
+        self.invalidate_bounds()
+        self.parts = []
+        for part_meta in meta['parts']:
+            self.parts.append(Part(
+                name=part_meta['name'], head=part_meta['head'],
+                node_sets={name: arrays[key] for name, key in part_meta['node_sets']},
+                element_sets={name: arrays[key]
+                              for name, key in part_meta['element_sets']},
+                ))
+        self.segments = []
+        for segment in meta['segments']:
+            if segment['kind'] == 'text':
+                self.segments.append(inp_cache.decode_lines(arrays[segment['array']]))
+                continue
+            part = self.get_part(segment['part'])
+            if segment['kind'] == 'node':
+                section = NodeSection(segment['head'], segment['part'],
+                                      segment['start'], segment['stop'])
+                part.node_sections.append(section)
+            else:
+                section = ElementSection(segment['head'], arrays[segment['array']],
+                                         segment['part'])
+                part.element_sections.append(section)
+            self.segments.append(section)
+        if meta['part_head'] is not None:
+            self.part_head = meta['part_head']
+            self.part_name = meta['part_name']
+        self.set_units(meta['units'])
+        print(f"Loaded {self.f_path} from the cache in "
+              f"{time.time() - start_time:.2f}s")
+        return True
+
+    def save_cached_inp(self) -> None:
+        """Stores the parsed mesh in the inp cache."""
+        arrays = {'nodes': self.nodes}
+        segments = []
+        for segment in self.segments:
+            key = f'segment_{len(segments)}'
+            if isinstance(segment, NodeSection):
+                segments.append({'kind': 'node', 'head': segment.head,
+                                 'part': segment.part, 'start': segment.start,
+                                 'stop': segment.stop})
+            elif isinstance(segment, ElementSection):
+                segments.append({'kind': 'element', 'head': segment.head,
+                                 'part': segment.part, 'array': key})
+                arrays[key] = segment.elements
+            else:
+                segments.append({'kind': 'text', 'array': key})
+                arrays[key] = inp_cache.encode_lines(segment)
+        parts = []
+        for i, part in enumerate(self.parts):
+            part_meta = {'name': part.name, 'head': part.head,
+                         'node_sets': [], 'element_sets': []}
+            for kind, sets in (('node_sets', part.node_sets),
+                               ('element_sets', part.element_sets)):
+                for j, (name, ids) in enumerate(sets.items()):
+                    key = f'part_{i}_{kind}_{j}'
+                    part_meta[kind].append((name, key))
+                    arrays[key] = ids
+            parts.append(part_meta)
+        part_head = self.part_head if isinstance(self.part_head, str) else None
+        meta = {
+            'segments': segments,
+            'parts': parts,
+            'part_head': part_head,
+            'part_name': getattr(self, 'part_name', None),
+            'units': self.units,
+        }
+        inp_cache.store(self.f_path, meta, arrays, self.cache_folder,
+                        self.cache_size)
+
+    @property
+    def node_sections(self) -> list:
+        return [seg for seg in self.segments if isinstance(seg, NodeSection)]
+
+    @property
+    def element_sections(self) -> list:
+        return [seg for seg in self.segments if isinstance(seg, ElementSection)]
+
+    @property
+    def elements(self) -> np.ndarray:
+        """The elements of the first element section."""
+        sections = self.element_sections
+        return sections[0].elements if sections else None
+
+    @elements.setter
+    def elements(self, elements):
+        self.element_sections[0].elements = elements
+
+    @property
+    def elem_head(self) -> str:
+        """The heading of the first element section i.e. type."""
+        sections = self.element_sections
+        return sections[0].head if sections else None
+
+    @property
+    def _inp_head(self) -> list:
+        """Lines of the file before the first section."""
+        lines = []
+        for segment in self.segments:
+            if isinstance(segment, (NodeSection, ElementSection)):
+                break
+            lines.extend(segment)
+        return lines
+
+    @property
+    def _inp_tail(self):
+        """Lines of the file after the last section, "" if there are none."""
+        lines = []
+        for segment in self.segments[::-1]:
+            if isinstance(segment, (NodeSection, ElementSection)):
+                break
+            lines[:0] = segment
+        return lines if lines else ""
+
+    def get_part(self, name: str) -> Part:
+        for part in self.parts:
+            if part.name == name:
+                return part
+        raise KeyError(f"No part named {name} in {self.f_path}")
+
+    def section_nodes(self, section: NodeSection) -> np.ndarray:
+        """The rows of self.nodes of a node section, as a view."""
+        return self.nodes[section.start:section.stop]
+
+    def part_nodes(self, name: str) -> np.ndarray:
+        """The rows of self.nodes of all the node sections of a part."""
+        part = self.get_part(name)
+        return np.concatenate(
+            [self.section_nodes(section) for section in part.node_sections]
             )
-        node_index = n_indexes[0]
-
-        self._inp_head = data_list[:node_index]
-
-        [e_indexes, e_insts] = self.find_index(data_list, '*Element')
 
-        elem_index = e_indexes[0]
+    def read_inp(self):
+        """
+        Reads data from an ascii encoded inp file to the INPMesh object.
+        The file is memory-mapped and scanned once for keyword lines. Every
+        *Node and *Element block is parsed in bulk with np.loadtxt, the nodes
+        of all the blocks are concatenated into self.nodes so that a whole
+        assembly is morphed at once. *Nset and *Elset data is read into the
+        sets of each part and all the other text is kept for writing the
+        file back out.
+        """
+        self.segments = []
+        self.parts = []
+        node_blocks = []
+        num_nodes = 0
+        with open(self.f_path, 'rb') as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            keywords = self.find_keywords(data)
+            part = None
+            position = 0
+            for i, (name, start, end, line) in enumerate(keywords):
+                stop = keywords[i + 1][1] if i + 1 < len(keywords) else len(data)
+                options = keyword_options(line)
+                if name == 'part':
+                    part = Part(name=options.get('name'), head=line.strip())
+                    self.parts.append(part)
+                    continue
+                if name == 'end part':
+                    part = None
+                    continue
+                if name not in ('node', 'element', 'nset', 'elset'):
+                    continue
+                if part is None:
+                    part = self._model_part()
+
+                data_end = self._data_end(data, end, stop)
+                if name == 'nset':
+                    add_to_set(part.node_sets, options.get('nset'), self.parse_set(
+                        data[end:data_end], 'generate' in options))
+                    continue
+                if name == 'elset':
+                    add_to_set(part.element_sets, options.get('elset'), self.parse_set(
+                        data[end:data_end], 'generate' in options))
+                    continue
+
+                self.segments.append(self._text_lines(data[position:start]))
+                position = data_end
+                if name == 'node':
+                    nodes = self.parse_block(data[end:data_end], np.float64)
+                    section = NodeSection(line.strip(), part.name,
+                                          num_nodes, num_nodes + len(nodes))
+                    node_blocks.append(nodes)
+                    num_nodes += len(nodes)
+                    part.node_sections.append(section)
+                    if 'nset' in options:
+                        add_to_set(part.node_sets, options['nset'], nodes[:, 0])
+                else:
+                    elements = self.parse_block(data[end:data_end], np.int64)
+                    section = ElementSection(line.strip(), elements, part.name)
+                    part.element_sections.append(section)
+                    if 'elset' in options:
+                        add_to_set(part.element_sets, options['elset'], elements[:, 0])
+                self.segments.append(section)
+            self.segments.append(self._text_lines(data[position:]))
+        self.segments = [seg for seg in self.segments
+                         if not isinstance(seg, list) or seg]
+
+        if not node_blocks:
+            raise ParsingError('*Node', (
+                "Check that the input file is correctly written."
+                ))
+        if not self.element_sections:
+            raise ParsingError('*Element', (
+                "Check that the input file is correctly written."
+                ))
+        self.nodes = np.concatenate(node_blocks)
+
+        named_parts = [part for part in self.parts if part.name is not None]
+        if len(named_parts) == 1:
+            self.part_head = named_parts[0].head
+            self.part_name = named_parts[0].name
+        elif named_parts:
+            print(f"Read {len(named_parts)} parts with "
+                  f"{len(self.node_sections)} node and "
+                  f"{len(self.element_sections)} element sections")
+        else:
+            print("No *PART found, contining without parts")
 
-        self.elem_head = e_insts[0].strip()
+        self.invalidate_bounds()
+        self.detect_units()
 
-        node_list = data_list[node_index + 1: elem_index]
+    def _model_part(self) -> Part:
+        """The part holding the data outside of any *Part."""
+        for part in self.parts:
+            if part.name is None:
+                return part
+        part = Part()
+        self.parts.append(part)
+        return part
 
-        self.nodes = (
-            np.array([[float(item.strip()) for item in line.split(',')]
-                      for line in node_list])
-            )
+    @staticmethod
+    def find_keywords(data) -> list:
+        """
+        Finds every keyword line (starting with a single *) in the bytes of
+        an inp file. Returns a list of (name, start, end, line) where name is
+        the lower case keyword, start and end are the byte offsets of the
+        line and its end (after the newline) and line is its text.
+        """
+        keywords = []
+        for match in KEYWORD_PATTERN.finditer(data):
+            line = match.group(0).decode('utf-8').rstrip('\r')
+            end = match.end() + 1 if match.end() < len(data) else match.end()
+            name = line[1:].split(',')[0].strip().lower()
+            keywords.append((name, match.start(), end, line + '\n'))
+        return keywords
 
-        [elem_list, elem_end] = self.find_elements(elem_index + 1, data_list)
+    @staticmethod
+    def _data_end(data, start, end) -> int:
+        """
+        Byte offset of the end of the last data line of a keyword, the lines
+        from start to end that follow the data (comments or blank lines) are
+        kept as text.
+        """
+        while end > start:
+            line_start = max(data.rfind(b'\n', start, end - 1) + 1, start)
+            if DATA_PATTERN.match(data, line_start, end):
+                return end
+            end = line_start
+        return start
 
-        self.elements = (
-            np.array([[int(item.strip()) for item in line.split(',')]
-                      for line in elem_list])
-            )
+    @staticmethod
+    def _text_lines(block) -> list:
+        """Splits bytes of the file into lines as readlines would."""
+        return block.decode('utf-8').replace('\r\n', '\n').splitlines(keepends=True)
 
-        if len(data_list) == elem_end:
-            self._inp_tail = ""
-        else:
-            self._inp_tail = data_list[elem_end:]
+    @staticmethod
+    def parse_block(block, dtype) -> np.ndarray:
+        """
+        Parses a block of comma separated data lines into a 2D array. Lines
+        ending with a comma (the Abaqus 16 item limit) are joined with the
+        next line first.
+        """
+        block = CONTINUATION_PATTERN.sub(b',', block)
+        return np.loadtxt(io.BytesIO(block), dtype=dtype, delimiter=',',
+                          comments='**', ndmin=2)
 
-        x1 = np.max(self.nodes[:, 1])
-        x2 = np.min(self.nodes[:, 1])
-        # Not very good way of doing this assumes meters if the mesh is smaller than one in its width in the x axis and otherwise assumes millimeters
-        if abs(x1 - x2) > 1:
-            self.set_units("mm")
-        else:
-            self.set_units("m")
+    @staticmethod
+    def parse_set(block, generate: bool = False) -> np.ndarray:
+        """
+        Parses the ids of the data lines of an *Nset or *Elset, expanding
+        the start, stop, step lines of generated sets.
+        """
+        lines = [line for line in block.splitlines() if DATA_PATTERN.match(line)]
+        ids = np.array(re.findall(rb'[-+]?\d+', b' '.join(lines)), dtype=np.int64)
+        if generate:
+            ids = np.concatenate(
+                [np.arange(a, b + 1, c) for a, b, c in ids.reshape(-1, 3)]
+                + [np.zeros(0, dtype=np.int64)]
+                )
+        return ids
 
     def update_nodes(self, nodes):
-        for i, node in enumerate(nodes):
-            for j, coord in enumerate(node):
-                self.nodes[i, j+1] = coord
+        """Sets the coordinates of the nodes, in place of the old ones."""
+        self.nodes[:, 1:] = nodes
+        self.invalidate_bounds()
 
     def scale_mesh(self, factor):
         """ Scales the mesh by a given factor.
         Mostly used to change the units.
         """
-        for i, node in enumerate(self.nodes):
-            self.nodes[i][1:] = node[1:]*factor
-
-    def find_elements(self, starting_index, data_list):
-        """Finds the number of elements in the inp file. """
-        index = starting_index
-        elements = []
-        more_elements = True
-        skip = 0
-        while more_elements:
-            # The following combines lines that have been split in the inp file due to the 16 item limit. It checks if the line ends with a comma, if it does it combines
-            if data_list[index].strip().endswith(','):
-                data_list[index] = data_list[index].strip() + data_list[index+1].strip()
-                skip = 1
-            else:
-                skip = 0
-            elements.append(data_list[index])
-            index += 1 + skip
-            try:
-                int(data_list[index].split(',')[0])
-            except:
-                return elements, index-1-skip
-        return elements, index-1-skip
-
-    def find_index(self, data_list, keyword_input):
-        """ Finds the index if a keyword in a file list. """
-        wildcard = '*'
-        instances = fnm.filter(data_list, keyword_input + wildcard)
-        index = []
-        if len(instances) > 0:
-            for instance in instances:
-                index.append(data_list.index(instance))
-            return [index, instances]
-        else:
-            raise ParsingError(keyword_input, (
-                "Check that the input file is correctly written."
-                ))
+        self.nodes[:, 1:] *= factor
+        self.invalidate_bounds()
 
     def save_mesh(self, file_path):
         """ Saves the mesh as an inp mesh. """
         self.write_inp(file_path=file_path)
 
-    def write_inp(self, file_name: str = None, file_path: str = None):
-        """Write the changed inp file."""
+    def write_inp(self, file_name: str = None, file_path: str = None,
+                  items_per_line: int = None, chunk_size: int = 65536):
+        """
+        Write the changed inp file, section by section. The node and element
+        blocks are formatted
+        chunk_size rows at a time with a single string format per chunk.
+        items_per_line splits element lines after that many items, ending
+        the split lines with a comma (Abaqus allows 16 items per line), by
+        default each element is written on one line.
+        """
         if file_path:
             f_path = file_path
         elif file_name:
@@ -641,61 +1073,55 @@ class INPMesh(Mesh):
                 file_name[:-4] if file_name[-4:] == '.inp' else file_name
                 )
             f_path = self.path(file_name)
-        with open(f_path, 'w', encoding="utf-8") as file:
-            for line in self._inp_head:
-                file.write(line)
-            # file.write(f'{self.part_head}\n')
-            file.write('*Node\n')
-            for node in self.nodes:
-                file.write(
-                    f"{int(node[0]):>7},  {node[1]:>11},  {node[2]:>11},  "
-                    f"{node[3]:>11}\n"
-                    )
-            file.write(f'{self.elem_head}\n')
-
-            for element in self.elements:
-                file.write(f'{element[0]}')
-                for item in element[1:]:
-                    file.write(f', {item}')
-                file.write('\n')
-            for line in self._inp_tail:
-                file.write(line)
-
-    def write_stl(self, file_path: str = None):
-        """Writes the inp mesh as a stl."""
-        if len(self.elements[0]) != 4:
+        start_time = time.time()
+        with open(f_path, 'w', encoding="utf-8", buffering=1 << 20) as file:
+            for segment in self.segments:
+                if isinstance(segment, NodeSection):
+                    file.write(f'{segment.head}\n')
+                    write_rows(file, self.section_nodes(segment), NODE_FORMAT,
+                               chunk_size)
+                elif isinstance(segment, ElementSection):
+                    file.write(f'{segment.head}\n')
+                    row_format = element_format(segment.elements.shape[1],
+                                                items_per_line)
+                    write_rows(file, segment.elements, row_format, chunk_size)
+                else:
+                    file.writelines(segment)
+        print(f"Written {f_path} in {time.time() - start_time:.2f}s")
+
+    def write_stl(self, file_path: str = None, binary: bool = True):
+        """
+        Writes the inp mesh as a stl, binary unless binary is False. The
+        triangles of every element section are written, with the node ids of
+        each section looked up in the nodes of its own part.
+        """
+        sections = self.element_sections
+        if any(section.elements.shape[1] != 4 for section in sections):
             raise ValueError('You cannot only convert a trimesh to stl')
         if file_path:
             path = file_path
         else:
             path = self.path(file_type='stl')
-        with open(path, 'w', encoding="utf-8") as file:
-            file.write(f'solid "{self.part_name}"\n')
-            for element in self.elements:
-                nodes = self.nodes[[i-1 for i in element[1:]]]
-                normals = self.calculate_normals(nodes)
-                file.write('  facet normal '
-                           f'{float(f"{normals[0]:.12g}"):g} '
-                           f'{float(f"{normals[1]:.12g}"):g} '
-                           f'{float(f"{normals[2]:.12g}"):g}\n')
-                file.write('    outer loop\n')
-                for i in range(3):
-                    file.write('      vertex')
-                    for j in range(3):
-                        file.write(f' {nodes[i][j+1]}')
-                    file.write('\n')
-                file.write('    endloop\n')
-                file.write('  endfacet\n')
-            file.write(f'endsolid "{self.part_name}"')
+        triangles = []
+        for section in sections:
+            nodes = self.part_nodes(section.part)
+            # Rows of the part's nodes of the node ids of each element
+            sorter = np.argsort(nodes[:, 0])
+            rows = sorter[np.searchsorted(nodes[:, 0], section.elements[:, 1:],
+                                          sorter=sorter) % len(nodes)]
+            if not np.array_equal(nodes[rows, 0], section.elements[:, 1:]):
+                raise ValueError(f'{section.head} uses nodes that are not in '
+                                 f'part {section.part}')
+            triangles.append(nodes[rows, 1:])
+        stl_io.write_stl(path, np.concatenate(triangles), binary=binary,
+                         name=f'"{getattr(self, "part_name", self.name)}"')
 
     def calculate_normals(self, nodes):
         """Calculates the normals for each face."""
         v1 = nodes[0][1:4] - nodes[1][1:4]
         v2 = nodes[0][1:4] - nodes[2][1:4]
         normal_vector = np.cross(v1, v2)
-        magnitude = (
-            normal_vector[0]**2 + normal_vector[1]**2 + normal_vector[2]**2
-            )
+        magnitude = np.linalg.norm(normal_vector)
         unit_normal_vector = normal_vector / magnitude
         return unit_normal_vector
 
@@ -711,10 +1137,8 @@ class INPMesh(Mesh):
 
     def apply_transformation(self, transformation_matrix):
         """ Applies a given transformation matrix to a mesh. """
-        for i, node in enumerate(self.nodes):
-            self.nodes[i][1:] = np.dot(
-                transformation_matrix, np.append(node[1:], 1)
-                )[:3]
+        transform_points(self.nodes[:, 1:], transformation_matrix)
+        self.invalidate_bounds()
 
     def save_boundary_nodes(self, file_name: str) -> None:
         """
@@ -724,22 +1148,112 @@ class INPMesh(Mesh):
         self.boundary_nodes_path = file_path
         np.save(file_path, self.boundary_nodes)
 
-    def get_bounding_box(self) -> list:
-        """
-        Somewhat redundent seeing as I have the units check in the load mesh.
-        """
-        maximums = [coord for coord in self.nodes[0, 1:]]
-        minimums = [coord for coord in self.nodes[0, 1:]]
-        for node in self.nodes:
-            for i, coord in enumerate(node[1:]):
-                if coord > maximums[i]:
-                    maximums[i] = coord
-                elif coord < minimums[i]:
-                    minimums[i] = coord
-        centroid = [(maximums[i] + minimums[i])/2 for i in range(3)]
-        difference = [maximums[i] - minimums[i] for i in range(3)]
-        return centroid, difference, maximums, minimums
-    
+
+def order_boundary_loops(edges) -> list:
+    """
+    Chains an (n, 2) array of boundary edges into loops. Returns a list of
+    the loops, longest first, each an array of edges ordered so that every
+    edge starts at the node the previous one ends at. A node to edge lookup
+    is built with one argsort so the chaining is O(n).
+    """
+    edges = np.asarray(edges)
+    flat = edges.ravel()
+    order = np.argsort(flat, kind='stable')
+    nodes, starts = np.unique(flat[order], return_index=True)
+    ends = np.append(starts[1:], len(flat))
+    # The edges touching node nodes[k] are incident[starts[k]:ends[k]]
+    incident = (order // 2).tolist()
+    position = dict(zip(nodes.tolist(), zip(starts.tolist(), ends.tolist())))
+    edge_list = edges.tolist()
+
+    used = [False] * len(edge_list)
+    loops = []
+    for first in range(len(edge_list)):
+        if used[first]:
+            continue
+        used[first] = True
+        loop = [edge_list[first]]
+        start_node, current = edge_list[first]
+        while current != start_node:
+            start, end = position[current]
+            for edge in incident[start:end]:
+                if not used[edge]:
+                    break
+            else:
+                # The chain is open
+                break
+            used[edge] = True
+            a, b = edge_list[edge]
+            if a != current:
+                a, b = b, a
+            loop.append([a, b])
+            current = b
+        loops.append(np.array(loop, dtype=edges.dtype))
+    loops.sort(key=len, reverse=True)
+    return loops
+
+
+def transform_points(points, t_matrix) -> np.ndarray:
+    """
+    Applies a 4x4 homogeneous transformation matrix to an (n, 3) array of
+    points in place, as one matrix multiplication. Like the per point
+    product it replaces, the last row of the matrix is ignored.
+    """
+    t_matrix = np.asarray(t_matrix, dtype=np.float64)
+    points[...] = points @ t_matrix[:3, :3].T
+    points += t_matrix[:3, 3]
+    return points
+
+
+def smallest_uint(count: int):
+    """The smallest unsigned integer type that can index count items."""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if count <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.uint64
+
+
+def keyword_options(line: str) -> dict:
+    """
+    Options of a keyword line as a dict, keyed by the lower case option name.
+    Options without a value, such as generate, map to None.
+    """
+    options = {}
+    for item in line.strip().split(',')[1:]:
+        key, _, value = item.partition('=')
+        if key.strip():
+            options[key.strip().lower()] = value.strip() if value else None
+    return options
+
+
+def add_to_set(sets: dict, name: str, ids) -> None:
+    """Adds the ids to the set called name, creating it if needed."""
+    ids = np.asarray(ids, dtype=np.int64)
+    sets[name] = np.concatenate([sets[name], ids]) if name in sets else ids
+
+
+def element_format(num_items: int, items_per_line: int = None) -> str:
+    """
+    Format string of a line of an element block with num_items items, split
+    after every items_per_line items with the line ending in a comma.
+    """
+    if not items_per_line or items_per_line >= num_items:
+        return ', '.join(['%d'] * num_items) + '\n'
+    lines = []
+    for start in range(0, num_items, items_per_line):
+        lines.append(', '.join(['%d'] * min(items_per_line, num_items - start)))
+    return ',\n'.join(lines) + '\n'
+
+
+def write_rows(file, array, row_format: str, chunk_size: int = 65536) -> None:
+    """
+    Writes each row of a 2D array to file with row_format, formatting
+    chunk_size rows at a time with one % operation over the whole chunk.
+    """
+    for start in range(0, len(array), chunk_size):
+        chunk = array[start:start + chunk_size]
+        file.write((row_format * len(chunk)) % tuple(chunk.ravel().tolist()))
+
 
 def something():
     pass
@@ -1,10 +1,26 @@
 # -*- coding: utf-8 -*-
 from HexMeshMorpher.MeshObj import TriMesh
 import time
-from multiprocessing import Process, Queue, Lock, Array
-import queue
+import tracemalloc
+from itertools import combinations_with_replacement
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
 import numpy as np
-import os
+from HexMeshMorpher.treecode import TreeCode, build_octree
+from HexMeshMorpher.container import write_container, read_container
+from scipy import sparse
+from scipy.linalg import (
+    LinAlgError, cho_factor, cho_solve, lapack, lu_factor, lu_solve,
+    solve_triangular
+)
+from scipy.sparse import linalg as sparse_linalg
+from scipy.spatial import cKDTree
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
 
 class RBFMorpher:
     """Class that handles the interpolation of the displacement field
@@ -17,7 +33,18 @@ class RBFMorpher:
                  displaced_mesh: TriMesh=None,
                  use_multithread: bool=False,
                  use_vectorised: bool=True,
-                 processors: int=6):
+                 use_chunked: bool=False,
+                 use_float32: bool=False,
+                 memory_limit: float=1024.0,
+                 solver: str='direct',
+                 solver_tolerance: float=1e-10,
+                 centre_tolerance: float=None,
+                 treecode_tolerance: float=None,
+                 polynomial_degree: int=None,
+                 execution: str=None,
+                 processors: int=6,
+                 threads: int=None,
+                 blas_threads: int=1):
 
         if (
             callable(displaced_mesh)
@@ -30,11 +57,37 @@ class RBFMorpher:
         self.RBF = RBF
         self.use_multithread = use_multithread
         self.use_vectorised = use_vectorised
+        self.use_chunked = use_chunked
+        self.use_float32 = use_float32 # float32 distance/RBF tiles, see _evaluate_dense
+        self.memory_limit = memory_limit # MB available to each tile of the chunked evaluation
+        self.solver = solver # 'direct', 'cg' or 'gmres'
+        self.solver_tolerance = solver_tolerance
+        self.subdomain_size = 500 # Centres per block of the GMRES preconditioner
+        self.subdomain_overlap = 0.5
+        self.gmres_restart = 50 # Krylov vectors kept between GMRES restarts
+        self.gmres_maxiter = 200 # Maximum number of GMRES restart cycles
+        self.solver_info = None
+        self.polynomial_degree = polynomial_degree # None for no polynomial tail
+        self.treecode_tolerance = treecode_tolerance # Approximate global RBFs with a treecode
+        self.execution = execution # None, 'threads' or 'processes'
         self.processors = processors
-        self.tasks_per_packet = 1000
+        self.threads = threads # Defaults to processors
+        self.blas_threads = blas_threads # BLAS threads used by each thread
+        self.evaluation_time = None
+        self.peak_memory = None
+        self.trace_memory = False # Measure peak_memory with tracemalloc
 
         self.interp_matrix = None
+        self.factor = None # Cached factorisation of the interpolation matrix
         self.coeff_matrix = None
+        self.poly_coeff_matrix = None
+        self.poly_origin = None
+        self.poly_scale = None
+        self.centres = None
+        self.centre_indices = None # Subset of the source vertices used as centres
+        self.centre_error = None
+        self.centre_solve_time = None
+        self.units = None
 
         if original_mesh is not None:
             self.set_original_mesh(original_mesh)
@@ -42,17 +95,33 @@ class RBFMorpher:
             self.set_displaced_mesh(displaced_mesh)
         
         if original_mesh is not None and displaced_mesh is not None:
-            self.generate_interpolation_matrix()
-            self.generate_coefficient_matrix()
+            if centre_tolerance is not None:
+                self.select_centres(centre_tolerance)
+            else:
+                self.generate_interpolation_matrix()
+                self.generate_coefficient_matrix()
+
+    @property
+    def support_radius(self):
+        """The support radius of a compactly supported RBF, otherwise None."""
+        return getattr(self.RBF, 'support_radius', None)
+
+    @property
+    def centre_displacements(self):
+        """The displacements of the source vertices used as centres."""
+        if self.centre_indices is None:
+            return self.source_v_disp
+        return self.source_v_disp[self.centre_indices]
 
-    def __magnitude(self, vector):
-        return np.sqrt(vector.dot(vector))
-    
     def set_original_mesh(self, original_mesh: TriMesh):
         """Sets the original mesh and its vertices."""
         self.original_source_vertices = np.array(original_mesh.trimesh.vertices)
         self.n = len(self.original_source_vertices)
-        self.interp_matrix = np.zeros((self.n,self.n))
+        self.units = getattr(original_mesh, 'units', None)
+        self.interp_matrix = None
+        self.factor = None
+        self.centres = self.original_source_vertices
+        self.centre_indices = None
 
     def set_displaced_mesh(self, displaced_mesh: TriMesh):
         """Sets the displaced mesh and its vertices."""
@@ -62,9 +131,29 @@ class RBFMorpher:
         """Generates interpolation matrix for transformation field."""
         start_time = time.time()
         print("Generating Interpolation Matrix")
+        self.factor = None
+
+        if self.support_radius is not None:
+            # Only pairs closer than the support radius are non-zero
+            V = self.centres
+            tree = cKDTree(V)
+            pairs = tree.sparse_distance_matrix(
+                tree, self.support_radius, output_type='ndarray')
+            self.interp_matrix = sparse.csr_matrix(
+                (self.RBF(pairs['v']), (pairs['i'], pairs['j'])),
+                shape=(len(V), len(V)))
+            print(f"Sparse Interpolation Matrix has {self.interp_matrix.nnz} non-zeros")
+            print("Successfully Generated Interpolation Matrix in {:.2f}s".format(time.time() - start_time))
+            return
+
+        if self.solver == 'gmres':
+            # The matrix is applied on the fly by generate_coefficient_matrix
+            self.interp_matrix = None
+            print("Interpolation Matrix is matrix-free for the GMRES solver")
+            return
 
         # Compute pairwise Euclidean distances in a vectorized way
-        V = self.original_source_vertices  # shape: (n, d)
+        V = self.centres  # shape: (n, d)
         diffs = V[:, np.newaxis, :] - V[np.newaxis, :, :]  # shape: (n, n, d)
         distances = np.sqrt(np.sum(diffs ** 2, axis=-1))   # shape: (n, n)
 
@@ -73,6 +162,89 @@ class RBFMorpher:
 
         print("Successfully Generated Interpolation Matrix in {:.2f}s".format(time.time() - start_time))
 
+    def select_centres(self, tolerance: float, initial_centres: int=None,
+                       centres_per_step: int=None, max_centres: int=None):
+        """
+        Greedily selects a subset of the source vertices to use as centres.
+        Starting from an evenly spaced subset, the system is solved, the
+        displacement error is evaluated at all the source vertices and the
+        worst ones are added as centres until the maximum error is within
+        tolerance. The achieved error is stored in self.centre_error and the
+        time spent solving in self.centre_solve_time.
+
+        With the dense direct solver the factorisation of the previous step
+        is bordered with the rows of the new centres, so the whole selection
+        costs about as much as one factorisation of the final system. Other
+        solvers rebuild the system every step, so the number of centres
+        added grows with the number already chosen.
+        """
+        start_time = time.time()
+        n_all = len(self.original_source_vertices)
+        if initial_centres is None:
+            initial_centres = max(n_all // 100, 10)
+        if centres_per_step is None:
+            centres_per_step = max(n_all // 200, 10)
+        if max_centres is None:
+            max_centres = n_all
+        print("Selecting RBF Centres")
+
+        bordered = None
+        if self.solver == 'direct' and self.support_radius is None:
+            bordered = _BorderedFactor()
+        chosen = np.zeros(n_all, dtype=bool)
+        added = np.linspace(0, n_all - 1, min(initial_centres, n_all)).astype(int)
+        self.centre_indices = np.zeros(0, dtype=np.int64)
+        self.centre_solve_time = 0.0
+        while True:
+            chosen[added] = True
+            self.centre_indices = np.concatenate((self.centre_indices, added))
+            self.centres = self.original_source_vertices[self.centre_indices]
+            self.n = len(self.centre_indices)
+            solve_start = time.time()
+            if bordered is not None:
+                try:
+                    self._border_factor(bordered)
+                except LinAlgError:
+                    print("Warning: the bordered factorisation is singular, "
+                          "the system is refactorised every step instead")
+                    bordered = None
+            if bordered is None:
+                self.generate_interpolation_matrix()
+            self.generate_coefficient_matrix()
+            self.centre_solve_time += time.time() - solve_start
+
+            residual = self.source_v_disp - np.asarray(
+                self.calculate_displacements(self.original_source_vertices))
+            errors = np.linalg.norm(residual, axis=1)
+            self.centre_error = errors.max()
+            print(f"{self.n} centres, maximum error {self.centre_error:.3g}")
+            errors[chosen] = 0.0
+            candidates = np.flatnonzero(errors > tolerance)
+            if len(candidates) == 0 or self.n >= max_centres:
+                break
+            number = centres_per_step if bordered is not None \
+                else max(centres_per_step, self.n // 4)
+            number = min(number, len(candidates), max_centres - self.n)
+            added = candidates[np.argpartition(errors[candidates], -number)[-number:]]
+
+        print(f"Selected {self.n} of {n_all} centres with maximum error "
+              f"{self.centre_error:.3g} in {time.time() - start_time:.2f}s "
+              f"({self.centre_solve_time:.2f}s solving)")
+        return self.centre_indices
+
+    def _border_factor(self, bordered):
+        """
+        Borders the factorisation with the centres that are not in it yet and
+        caches it as self.factor. The interpolation matrix is not stored, it
+        is generated again if it is needed.
+        """
+        old, new = self.centres[:len(bordered)], self.centres[len(bordered):]
+        bordered.add(
+            self.RBF(np.linalg.norm(old[:, np.newaxis] - new[np.newaxis], axis=2)),
+            self.RBF(np.linalg.norm(new[:, np.newaxis] - new[np.newaxis], axis=2)))
+        self.interp_matrix = None
+        self.factor = (self.polynomial_degree, 'bordered', bordered)
+
     def save_interpolation_matrix(self, file_name):
         """Saves inperpolation matrixs as a npy file."""
         np.save(file_name, self.interp_matrix)
@@ -82,6 +254,7 @@ class RBFMorpher:
         start_time = time.time()
         print("Loading Interpolation Matrix")
         self.interp_matrix = np.load(file_name)
+        self.factor = None
         print("Interpolation Matrix Loaded Successfully in "+str(time.time()-start_time)+"s")
 
     def generate_coefficient_matrix(self):
@@ -90,11 +263,236 @@ class RBFMorpher:
         start_time = time.time()
         print("Generating Coefficient Matrix")
 
-        # Solve interp_matrix * X = source_v_disp for X
-        self.coeff_matrix = np.linalg.solve(self.interp_matrix, self.source_v_disp)
+        self.coeff_matrix, self.poly_coeff_matrix = self._solve(self.centre_displacements)
 
         print("Successfully Generated Coefficient Matrix in {:.2f}s".format(time.time() - start_time))
 
+    def solve_displacement_fields(self, displaced_meshes: list) -> list:
+        """
+        Solves for the coefficients of several displaced meshes of the same
+        original mesh, e.g. Amberg mappings onto different targets, as one
+        multi right-hand side batch. With a direct solver the interpolation
+        matrix is only factorised once. Returns a list of
+        (coeff_matrix, poly_coeff_matrix) for each of the meshes.
+        """
+        start_time = time.time()
+        print(f"Solving for {len(displaced_meshes)} Displacement Fields")
+        displacements = [
+            np.array(mesh.trimesh.vertices) - self.original_source_vertices
+            for mesh in displaced_meshes]
+        if self.centre_indices is not None:
+            displacements = [disp[self.centre_indices] for disp in displacements]
+        coeffs, poly_coeffs = self._solve(np.concatenate(displacements, axis=1))
+        results = []
+        for i, disp in enumerate(displacements):
+            columns = slice(3*i, 3*i + disp.shape[1])
+            results.append((coeffs[:, columns],
+                            None if poly_coeffs is None else poly_coeffs[:, columns]))
+        print("Successfully Solved Displacement Fields in {:.2f}s".format(time.time() - start_time))
+        return results
+
+    def _solve(self, displacements):
+        """
+        Solves the interpolation system for the displacements of the centres,
+        which may have any number of columns. Returns the RBF coefficients
+        and the polynomial coefficients (None without a polynomial tail).
+        """
+        n = len(displacements)
+        rhs = displacements
+        P = None
+        if self.polynomial_degree is not None:
+            # Augment with the saddle point system [[A, P], [P^T, 0]]
+            self.poly_origin = self.centres.mean(axis=0)
+            self.poly_scale = max(np.ptp(self.centres, axis=0).max(), np.finfo(float).tiny)
+            P = self._polynomial_matrix(self.centres)
+            rhs = np.concatenate((rhs, np.zeros((P.shape[1], rhs.shape[1]))))
+
+        if self.solver == 'gmres' and self.interp_matrix is None:
+            solution = self._matrix_free_solve(rhs, P)
+        elif self.solver == 'cg':
+            if P is not None:
+                raise ValueError("The CG solver needs a positive definite system, "
+                                 "use the direct or GMRES solver with a polynomial tail.")
+            if self.interp_matrix is None:
+                # e.g. a loaded morph model
+                self.generate_interpolation_matrix()
+            # Conjugate gradients, one solve per displacement component
+            solution = np.zeros(np.shape(rhs))
+            for i in range(solution.shape[1]):
+                solution[:, i], info = sparse_linalg.cg(
+                    self.interp_matrix, rhs[:, i],
+                    rtol=self.solver_tolerance)
+                if info != 0:
+                    print(f"CG did not converge for component {i} (info = {info})")
+        else:
+            solution = self._factorised_solve(rhs, P)
+
+        return solution[:n], (solution[n:] if P is not None else None)
+
+    def _factorised_solve(self, rhs, P=None):
+        """
+        Solves the (augmented) interpolation system with a direct solver. The
+        factorisation is cached so that new right-hand sides only cost
+        O(n^2). Dense matrices are factorised with Cholesky when they are
+        positive definite and with a symmetric indefinite LDL^T otherwise,
+        which includes every system augmented with the polynomial P, sparse
+        matrices with SuperLU. The bordered factorisation left by
+        select_centres is used as it is. Without a matrix or a
+        factorisation, e.g. for a loaded morph model, the matrix is generated
+        from the centres.
+        """
+        degree = self.polynomial_degree
+        if self.factor is None or self.factor[0] != degree:
+            if self.interp_matrix is None:
+                self.generate_interpolation_matrix()
+            start_time = time.time()
+            matrix = self.interp_matrix
+            if sparse.issparse(matrix):
+                if P is not None:
+                    matrix = sparse.bmat([[matrix, sparse.csr_matrix(P)],
+                                          [sparse.csr_matrix(P.T), None]])
+                kind, factor = 'splu', sparse_linalg.splu(sparse.csc_matrix(matrix))
+            else:
+                if P is not None:
+                    matrix = np.block([[matrix, P],
+                                       [P.T, np.zeros((P.shape[1], P.shape[1]))]])
+                kind, factor = None, None
+                if P is None:
+                    # The saddle-point system with P is never positive definite
+                    try:
+                        kind, factor = 'cholesky', cho_factor(matrix, check_finite=False)
+                    except LinAlgError:
+                        pass
+                if factor is None:
+                    lwork = int(lapack.dsytrf_lwork(len(matrix))[0])
+                    ldu, ipiv, info = lapack.dsytrf(matrix, lwork=lwork)
+                    if info != 0:
+                        raise LinAlgError("The interpolation matrix is singular.")
+                    kind, factor = 'ldlt', (ldu, ipiv)
+            self.factor = (degree, kind, factor)
+            print(f"Factorised Interpolation Matrix ({kind}) in "
+                  f"{time.time() - start_time:.2f}s")
+
+        _, kind, factor = self.factor
+        if kind == 'splu':
+            return factor.solve(rhs)
+        if kind == 'bordered':
+            return factor.solve(rhs, P)
+        if kind == 'cholesky':
+            return cho_solve(factor, rhs, check_finite=False)
+        solution, info = lapack.dsytrs(factor[0], factor[1], rhs)
+        if info != 0:
+            raise LinAlgError(f"Solving with the LDL^T factorisation failed (info={info}).")
+        return solution
+
+    def _polynomial_matrix(self, points):
+        """
+        Returns the monomials up to self.polynomial_degree of the points,
+        shifted and scaled by the centres for conditioning.
+        """
+        x = (np.asarray(points, dtype=np.float64) - self.poly_origin) / self.poly_scale
+        columns = [np.ones(len(x))]
+        for degree in range(1, self.polynomial_degree + 1):
+            for dims in combinations_with_replacement(range(3), degree):
+                columns.append(np.prod(x[:, dims], axis=1))
+        return np.column_stack(columns)
+
+    def _matrix_free_solve(self, rhs, P=None):
+        """
+        Solves the interpolation system with GMRES without storing the
+        interpolation matrix. The matrix is applied in memory-bounded tiles,
+        or with a treecode when self.treecode_tolerance is set, and
+        preconditioned with a restricted additive Schwarz method over
+        overlapping subdomains of neighbouring centres. The polynomial
+        block of an augmented system, P, is left unpreconditioned.
+
+        The columns of rhs are solved in lockstep, so each product with the
+        matrix builds the distance tiles once for all the columns. The
+        restart length and number of restart cycles are self.gmres_restart
+        and self.gmres_maxiter. The iterations, residual (of the treecode
+        product when it is used) and time per iteration of each component
+        are stored in self.solver_info.
+        """
+        V = self.centres
+        n = len(V)
+        treecode, plan = None, None
+        if self.treecode_tolerance is not None:
+            treecode = TreeCode(V, np.zeros((n, rhs.shape[1])), self.RBF,
+                                tolerance=self.treecode_tolerance)
+            plan = treecode.plan(V)
+
+        def matvec(x):
+            if treecode is not None:
+                treecode.set_coeffs(x[:n])
+                out = treecode.evaluate(V, plan=plan)
+            else:
+                out = np.zeros((n, x.shape[1]))
+                _evaluate_dense(V, V, x[:n], self.RBF, self.memory_limit, out)
+            if P is None:
+                return out
+            return np.concatenate((out + P @ x[n:], P.T @ x[:n]))
+
+        schwarz = self._schwarz_preconditioner()
+
+        def precondition(b):
+            return np.concatenate((schwarz.matmat(b[:n]), b[n:]))
+
+        start_time = time.time()
+        coeffs, iterations, converged = _lockstep_gmres(
+            matvec, precondition, rhs, self.solver_tolerance,
+            self.gmres_restart, self.gmres_maxiter)
+        elapsed = time.time() - start_time
+        norms = np.maximum(np.linalg.norm(rhs, axis=0), np.finfo(float).tiny)
+        residuals = np.linalg.norm(matvec(coeffs) - rhs, axis=0) / norms
+        products = max(int(iterations.max()), 1)
+        self.solver_info = []
+        for i in range(rhs.shape[1]):
+            self.solver_info.append({
+                'iterations': int(iterations[i]),
+                'residual': residuals[i],
+                'time_per_iteration': elapsed / products,
+                'converged': bool(converged[i]),
+            })
+            print(f"GMRES component {i}: {iterations[i]} iterations, relative "
+                  f"residual {residuals[i]:.3g}")
+        print(f"GMRES solved {rhs.shape[1]} components in lockstep in {elapsed:.2f}s, "
+              f"{elapsed / products:.3g}s per iteration")
+        return coeffs
+
+    def _schwarz_preconditioner(self):
+        """
+        Restricted additive Schwarz preconditioner. The centres are split into
+        the leaves of an octree and each is grown by its nearest neighbours.
+        The local matrices of the grown subdomains are LU factorised and each
+        solve only keeps the values of the centres the subdomain owns.
+        """
+        start_time = time.time()
+        V = self.centres
+        n = len(V)
+        leaves, order = build_octree(V, self.subdomain_size, leaves_only=True)
+        tree = cKDTree(V)
+        subdomains = []
+        for leaf in leaves:
+            owned = order[leaf['start']:leaf['end']]
+            size = min(n, int(len(owned) * (1.0 + self.subdomain_overlap)))
+            grown = tree.query(leaf['middle'], k=size)[1]
+            grown = np.union1d(np.atleast_1d(grown), owned)
+            local = self.RBF(np.linalg.norm(
+                V[grown][:, np.newaxis] - V[grown][np.newaxis], axis=2))
+            keep = np.searchsorted(grown, owned)
+            subdomains.append((owned, grown, keep, lu_factor(local)))
+        print(f"Schwarz preconditioner with {len(subdomains)} subdomains "
+              f"built in {time.time() - start_time:.2f}s")
+
+        def apply(b):
+            out = np.zeros(np.shape(b))
+            for owned, grown, keep, factor in subdomains:
+                out[owned] = lu_solve(factor, b[grown])[keep]
+            return out
+
+        return sparse_linalg.LinearOperator((n, n), matvec=apply, matmat=apply,
+                                            dtype=np.float64)
+
     def save_coefficient_matrix(self, file_name):
         """Saves coefficient matrix as a npy file."""
         np.save(file_name, self.coeff_matrix)
@@ -107,70 +505,111 @@ class RBFMorpher:
         self.n = self.coeff_matrix.shape[0]
         print("Coefficient Matrix Loaded Successfully in "+str(time.time()-start_time)+"s")
 
+    def save_morph_model(self, file_path, include_factor: bool=True):
+        """
+        Saves everything needed to morph into a single self-describing file:
+        the centres, the coefficients, the RBF and its parameters, the
+        polynomial tail, the units and optionally the dense factorisation of
+        the interpolation matrix. When the centres are a subset of the source
+        vertices, the source vertices and the indices of the centres are
+        saved too, so the loaded model can be re-solved for a displaced mesh.
+        """
+        start_time = time.time()
+        print("Saving Morph Model")
+        if self.coeff_matrix is None:
+            raise ValueError("The coefficient matrix must be generated before "
+                             "the morph model can be saved.")
+        arrays = {'centres': self.centres, 'coeffs': self.coeff_matrix}
+        if self.centre_indices is not None:
+            arrays['source_vertices'] = self.original_source_vertices
+            arrays['centre_indices'] = self.centre_indices
+        meta = {
+            'format': 'RBFMorphModel',
+            'version': 1,
+            'kernel': _kernel_spec(self.RBF),
+            'units': self.units,
+            'polynomial_degree': self.polynomial_degree,
+            'factor': None,
+        }
+        if self.poly_coeff_matrix is not None:
+            arrays['poly_coeffs'] = self.poly_coeff_matrix
+            meta['poly_origin'] = [float(x) for x in self.poly_origin]
+            meta['poly_scale'] = float(self.poly_scale)
+        if include_factor and self.factor is not None \
+                and self.factor[1] not in ('splu', 'bordered'):
+            degree, kind, factor = self.factor
+            meta['factor'] = {'kind': kind, 'polynomial_degree': degree}
+            if kind == 'cholesky':
+                arrays['factor'] = factor[0]
+                meta['factor']['lower'] = bool(factor[1])
+            else:
+                arrays['factor'], arrays['factor_pivots'] = factor
+        write_container(file_path, meta, arrays)
+        print(f"Morph Model Saved Successfully in {time.time() - start_time:.2f}s")
+
+    def load_morph_model(self, file_path, mmap_mode: str='r', verify: bool=False):
+        """
+        Loads a morph model saved by save_morph_model. By default the arrays
+        are memory-mapped, so many processes can share one model on disk
+        with almost no start-up cost. verify checks the checksum of the data.
+        """
+        start_time = time.time()
+        print("Loading Morph Model")
+        meta, arrays = read_container(file_path, mmap_mode=mmap_mode, verify=verify)
+        if meta.get('format') != 'RBFMorphModel':
+            raise ValueError(f"{file_path} is not a morph model.")
+        self.RBF = _kernel_from_spec(meta['kernel'])
+        self.units = meta['units']
+        self.centres = arrays['centres']
+        self.original_source_vertices = arrays.get('source_vertices', self.centres)
+        self.centre_indices = arrays.get('centre_indices')
+        self.n = len(self.centres)
+        self.interp_matrix = None
+        self.coeff_matrix = arrays['coeffs']
+        self.polynomial_degree = meta['polynomial_degree']
+        if 'poly_coeffs' in arrays:
+            self.poly_coeff_matrix = arrays['poly_coeffs']
+            self.poly_origin = np.array(meta['poly_origin'])
+            self.poly_scale = meta['poly_scale']
+        else:
+            self.poly_coeff_matrix = None
+        self.factor = None
+        if meta['factor'] is not None:
+            kind = meta['factor']['kind']
+            if kind == 'cholesky':
+                factor = (arrays['factor'], meta['factor']['lower'])
+            else:
+                factor = (arrays['factor'], arrays['factor_pivots'])
+            self.factor = (meta['factor']['polynomial_degree'], kind, factor)
+        print(f"Morph Model Loaded Successfully in {time.time() - start_time:.2f}s")
+
     def calculate_displacements(self, points):
         """Calculates the individual displacements required by morph_vertices."""
         n_points = len(points)
         print("Calculating Displacements of "+str(n_points)+" points")
         start_time = time.time()
 
-        if self.use_multithread:
-            lock = Lock()
-            displacement_x = Array('f', n_points)
-            displacement_y = Array('f', n_points)
-            displacement_z = Array('f', n_points)
-            number_of_tasks = self.n
-            number_of_processes = self.processors
-            processes = []
-
-            # instantiating a queue object
-            tasks_to_do = Queue()
-            tasks_done = Queue()
-
-            print('Creating Task List')
-            for i in range(int(np.ceil(number_of_tasks/self.tasks_per_packet))):
-                if self.tasks_per_packet*(i + 1) - 1 > number_of_tasks:
-                    # To account for the last process where the number of tasks in the process is smaller 
-                    l = [ x for x in range(i*self.tasks_per_packet, number_of_tasks)]
-                else:
-                    l = [ x for x in range(i*self.tasks_per_packet, self.tasks_per_packet*(i + 1))]
-                print(f'Task packet {i} tasks {l[0]} to {l[-1]}')
-                tasks_to_do.put(l)
-
-            print(f'{number_of_tasks} to be completed')
-
-            # creating processes
-            print(f'Creating {number_of_processes} processes')
-            for w in range(number_of_processes):
-                p = Process(target=self.do_job,
-                            args=(tasks_to_do, tasks_done, points,
-                                  displacement_x, displacement_y,
-                                  displacement_z, lock))
-                processes.append(p)
-                p.start()
-
-            # completing process
-            print('Waiting for processes to finish')
-            for p in processes:
-                p.join()
-
-            # collecting results
-            print('Getting output from processes')
-            while not tasks_done.empty():
-                #print(f'Finished {tasks_done.get()}!')
-                tasks_done.get()
-
-            displacements = [
-                [displacement_x[i], displacement_y[i], displacement_z[i]]
-                for i in range(n_points)
-                ]
-
-            print("Displacements Successfully Calculated in "+str(time.time()-start_time)+"s")
-            return displacements
-        
+        if self.treecode_tolerance is not None and self.support_radius is None:
+            treecode = TreeCode(self.centres, self.coeff_matrix, self.RBF,
+                                tolerance=self.treecode_tolerance)
+            displacements = treecode.evaluate(points)
+
+        elif self.execution == 'threads':
+            displacements = self._threaded_displacements(points)
+
+        elif self.use_multithread or self.execution == 'processes':
+            displacements = self._parallel_displacements(points)
+
+        elif self.support_radius is not None:
+            displacements = self._compact_displacements(points)
+
+        elif self.use_chunked:
+            displacements = self._chunked_displacements(points)
+
         elif self.use_vectorised:
             # Non parallel calculation (fully vectorized)
-            # points: (m,3), original_source_vertices V: (n,3)
-            V = self.original_source_vertices
+            # points: (m,3), centres V: (n,3)
+            V = self.centres
             # compute pairwise distances between each point and each source vertex -> (m, n)
             diffs = points[:, np.newaxis, :] - V[np.newaxis, :, :]  # (m, n, 3)
             magnitudes = np.linalg.norm(diffs, axis=2)  # (m, n)
@@ -184,66 +623,555 @@ class RBFMorpher:
             for vertex_index in range(self.n):
                 displacements += self._disp_calculation_vectorized(vertex_index, points)
 
-        print("Displacements Successfully Calculated in "+str(time.time()-start_time)+"s")
+        if self.poly_coeff_matrix is not None:
+            displacements += self._polynomial_matrix(points) @ self.poly_coeff_matrix
+
+        self.evaluation_time = time.time() - start_time
+        print("Displacements Successfully Calculated in "+str(self.evaluation_time)+"s")
         return displacements
 
-    def do_job(self, tasks_to_do, tasks_done, points, displacement_x,
-               displacement_y, displacement_z, lock):
-        """ Function for multithreading task. """
-        while True:
-            try:
-                task = tasks_to_do.get_nowait()
-                # print(task)
-
-                if task == 'TERMINATE':
-                    tasks_to_do.put(task)
-                    break
-
-                disp = np.zeros((len(points), 3))
-                print("Displacement Caculating for: ", os.getpid())
-                for vertex_index in task:
-                    if self.use_vectorised:
-                        disp += self._disp_calculation_vectorized(vertex_index, points)
-                    else:
-                        disp += self._disp_calculation(vertex_index, points)
-                with lock:
-                    displacement_x[:] = displacement_x[:] + disp[:,0]
-                    displacement_y[:] = displacement_y[:] + disp[:,1]
-                    displacement_z[:] = displacement_z[:] + disp[:,2]
-                print(f"Process {os.getpid()} is finished.")
-                tasks_done.put(f'Task packet {int(task[0]/self.tasks_per_packet)}')
-            except queue.Empty:
-                break
+    def _chunked_displacements(self, points):
+        """
+        Evaluates the displacements in tiles of target points (and source
+        vertices if needed) that fit within self.memory_limit. Distances are
+        found with the ||a||^2 + ||b||^2 - 2a.b identity so that the
+        (m, n, 3) array of differences is never formed. The peak memory of
+        the tile buffers and the result is stored in self.peak_memory in
+        bytes. It is measured with tracemalloc if self.trace_memory is set
+        and nothing else is tracing, otherwise it is found from the tile
+        shape.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        itemsize = np.dtype(self._compute_dtype).itemsize
+        rows, cols = _tile_shape(len(points), len(self.centres), self.memory_limit,
+                                 itemsize=itemsize)
+        print(f"Evaluating in tiles of {rows} points by {cols} source vertices")
+
+        trace = self.trace_memory and not tracemalloc.is_tracing()
+        if trace:
+            tracemalloc.start()
+        try:
+            displacements = np.zeros((len(points), 3))
+            _evaluate_dense(points, self.centres, self.coeff_matrix, self.RBF,
+                            self.memory_limit, displacements, self._compute_dtype)
+            if trace:
+                self.peak_memory = tracemalloc.get_traced_memory()[1]
             else:
-                print(f'Task packet {int(task[0]/self.tasks_per_packet)} is finished!')
-                time.sleep(.5)
-        return True
-
-    def _disp_calculation(self, vertex_index, points):
-        disps = np.zeros((len(points), 3))
-        for i, point in enumerate(points):
-            source_vertex = self.original_source_vertices[vertex_index]
-            diff_vec = point - source_vertex
-            disps[i] = self.coeff_matrix[vertex_index] * self.RBF(self.__magnitude(diff_vec))
-        return disps
-    
+                self.peak_memory = rows * cols * itemsize * 3 + displacements.nbytes
+        finally:
+            if trace:
+                tracemalloc.stop()
+        print("Peak memory used in displacement calculation: "
+              f"{self.peak_memory/2**20:.1f} MB")
+        return displacements
+
+    def _compact_displacements(self, points):
+        """
+        Evaluates the displacements for a compactly supported RBF, only
+        touching the source vertices within the support radius of each point.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        displacements = np.zeros((len(points), 3))
+        _evaluate_compact(points, cKDTree(self.centres), self.coeff_matrix,
+                          self.RBF, self._neighbours(), self.memory_limit,
+                          displacements)
+        return displacements
+
+    @property
+    def _compute_dtype(self):
+        return np.float32 if self.use_float32 else np.float64
+
+    def _neighbours(self):
+        """Average number of centres within the support radius of a centre."""
+        if sparse.issparse(self.interp_matrix):
+            return max(self.interp_matrix.nnz / self.interp_matrix.shape[0], 1.0)
+        return 64.0
+
+    def _threaded_displacements(self, points):
+        """
+        Evaluates the displacements with a pool of threads, each working on
+        tiles of the points and writing into a preallocated output. The heavy
+        lifting is done by NumPy/BLAS which releases the GIL, so there are no
+        process start-up or pickling costs. The number of BLAS threads used
+        by each thread is limited to self.blas_threads with threadpoolctl to
+        avoid oversubscribing the cores.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        displacements = np.zeros((len(points), 3))
+        threads = self.threads if self.threads else self.processors
+        memory_limit = self.memory_limit / threads
+        if self.support_radius is not None:
+            tree = cKDTree(self.centres)
+            neighbours = self._neighbours()
+            rows = max(int(memory_limit * 2**20 / (48 * neighbours)), 1)
+
+            def task(start, stop):
+                _evaluate_compact(points[start:stop], tree, self.coeff_matrix,
+                                  self.RBF, neighbours, memory_limit,
+                                  displacements[start:stop])
+        else:
+            rows = _tile_shape(len(points), len(self.centres), memory_limit,
+                               itemsize=np.dtype(self._compute_dtype).itemsize)[0]
+
+            def task(start, stop):
+                _evaluate_dense(points[start:stop], self.centres,
+                                self.coeff_matrix, self.RBF, memory_limit,
+                                displacements[start:stop], self._compute_dtype)
+
+        if threadpool_limits is not None and self.blas_threads:
+            limits = threadpool_limits(limits=self.blas_threads, user_api='blas')
+        else:
+            if self.blas_threads:
+                print(f"Warning: threadpoolctl is not installed, so the BLAS threads "
+                      f"can not be limited to {self.blas_threads} per thread")
+            limits = nullcontext()
+        print(f"Evaluating tiles of {rows} points on {threads} threads")
+        with limits, ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [executor.submit(task, start, min(start + rows, len(points)))
+                       for start in range(0, len(points), rows)]
+            for future in futures:
+                future.result()
+        return displacements
+
+    def _parallel_displacements(self, points):
+        """
+        Evaluates the displacements in a pool of self.processors processes.
+        The centres, coefficients, points and output are placed in shared
+        memory and each task evaluates a contiguous range of the points, so
+        the results are written straight into the output without any locking
+        or reduction.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        shared = {}
+        try:
+            for name, array in (('centres', self.centres),
+                                ('coeffs', self.coeff_matrix),
+                                ('points', points),
+                                ('out', np.zeros((len(points), 3)))):
+                shared[name] = _SharedArray.create(array)
+            specs = {name: block.spec() for name, block in shared.items()}
+
+            # Several ranges per process to balance the load
+            bounds = np.linspace(0, len(points), 4*self.processors + 1).astype(int)
+            ranges = [(int(start), int(stop))
+                      for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+            print(f"Evaluating {len(ranges)} ranges of points on "
+                  f"{self.processors} processes")
+            memory_limit = self.memory_limit / self.processors
+            with Pool(self.processors, initializer=_init_worker,
+                      initargs=(specs, self.RBF, self._neighbours(),
+                                memory_limit, self._compute_dtype)) as pool:
+                pool.starmap(_displacement_task, ranges)
+            displacements = shared['out'].array.copy()
+        finally:
+            for block in shared.values():
+                block.close(unlink=True)
+        return displacements
+
     def _disp_calculation_vectorized(self, vertex_index, points):
         """Vectorized version of displacement calculation."""
-        source_vertex = self.original_source_vertices[vertex_index]
+        source_vertex = self.centres[vertex_index]
         diff_vecs = points - source_vertex
         magnitudes = np.linalg.norm(diff_vecs, axis=1)
         rbf_vals = self.RBF(magnitudes)
         disps = self.coeff_matrix[vertex_index] * rbf_vals[:, np.newaxis]
         return disps
 
-    def morph_vertices(self, points):
-        """Takes a set of points and morphes them according to the transformation matix in self."""
+    def morph_vertices(self, points, out=None):
+        """
+        Takes a set of points and morphes them according to the transformation
+        matix in self. If out is given the morphed points are written into it,
+        which may be the points themselves to morph a plain array in place.
+        To morph a mesh pass the result to its update_nodes method instead of
+        writing into the mesh's nodes, so its cached bounds are invalidated.
+        """
         displacements = self.calculate_displacements(points)
-        new_vertices = np.zeros(np.shape(points))
-        for i, point in enumerate(points):
-            new_vertices[i] = np.add(point, displacements[i])
-        return new_vertices
+        if out is None:
+            return np.add(points, displacements)
+        return np.add(points, displacements, out=out)
+
+
+class _BorderedFactor:
+    """
+    Block LDL^T factorisation of a symmetric matrix that grows by bordering
+    it with new rows and columns, as the greedy centre selection does. Each
+    block of D is the LU factorised Schur complement of the rows added
+    together, so adding m rows to k costs O(k^2 m + m^3) instead of
+    refactorising the whole (k + m) square matrix.
+    """
+
+    def __init__(self):
+        self.lower = np.zeros((0, 0)) # Unit lower triangular L
+        self.blocks = [] # (rows, LU factor) of the diagonal blocks of D
+
+    def __len__(self):
+        return len(self.lower)
+
+    def _solve_blocks(self, y):
+        out = np.empty(np.shape(y))
+        for rows, factor in self.blocks:
+            out[rows] = lu_solve(factor, y[rows], check_finite=False)
+        return out
+
+    def add(self, border, corner):
+        """
+        Borders the matrix with border, the (k, m) block of the new columns
+        in the old rows, and corner, the (m, m) block of the new rows.
+        """
+        k, m = len(self), len(corner)
+        w = solve_triangular(self.lower, border, lower=True, unit_diagonal=True,
+                             check_finite=False) if k else np.zeros((0, m))
+        below = self._solve_blocks(w).T
+        factor = lu_factor(corner - below @ w, check_finite=False)
+        if not np.all(np.diag(factor[0])):
+            raise LinAlgError("The bordered interpolation matrix is singular.")
+        lower = np.zeros((k + m, k + m))
+        lower[:k, :k] = self.lower
+        lower[k:, :k] = below
+        lower[k:, k:] = np.eye(m)
+        self.lower = lower
+        self.blocks.append((slice(k, k + m), factor))
+
+    def solve(self, rhs, P=None):
+        """
+        Solves the system for rhs. With the polynomial block P the rows of
+        rhs after the matrix belong to the saddle point system [[A, P],
+        [P^T, 0]], which is solved through the Schur complement of P.
+        """
+        n = len(self)
+        if P is not None:
+            x = self.solve(rhs[:n])
+            y = self.solve(P)
+            poly = np.linalg.solve(P.T @ y, P.T @ x - rhs[n:])
+            return np.concatenate((x - y @ poly, poly))
+        y = solve_triangular(self.lower, rhs, lower=True, unit_diagonal=True,
+                             check_finite=False)
+        return solve_triangular(self.lower, self._solve_blocks(y), trans='T',
+                                lower=True, unit_diagonal=True, check_finite=False)
+
+
+def _lockstep_gmres(matvec, precondition, rhs, tolerance, restart, maxiter):
+    """
+    Restarted GMRES run on each column of rhs in lockstep. Each column has
+    its own Krylov space, but the products with the matrix and the
+    preconditioner are made for all the active columns at once, so matvec
+    and precondition take and return (size, k) blocks.
+
+    Each column follows scipy's gmres: the inner iterations work on the left
+    preconditioned residual, with a tolerance adapted after every restart
+    cycle until the true residual is below tolerance times the norm of the
+    right-hand side. maxiter is the number of restart cycles. Returns the
+    solution, the inner iterations of each column and whether each column
+    converged.
+    """
+    size, k = rhs.shape
+    x = np.zeros((size, k))
+    eps = np.finfo(float).eps
+    tiny = np.finfo(float).tiny
+    norms = np.maximum(np.linalg.norm(rhs, axis=0), tiny)
+    targets = tolerance * norms
+    # Tolerances of the preconditioned residual of the inner iterations
+    ptol = np.linalg.norm(precondition(rhs), axis=0) * min(1.0, tolerance)
+    ptol_factor = np.ones(k)
+    presid = np.zeros(k)
+    iterations = np.zeros(k, dtype=int)
+    ran = np.zeros(k, dtype=bool)
+    for cycle in range(maxiter + 1):
+        residual = rhs - matvec(x)
+        rnorm = np.linalg.norm(residual, axis=0)
+        converged = rnorm <= targets
+        # Adapt the inner tolerances of the columns that ran a cycle (gh-8400)
+        adapt = ran & ~converged
+        passed = presid <= ptol
+        ptol_factor[adapt & passed] = np.maximum(eps, 0.25 * ptol_factor[adapt & passed])
+        ptol_factor[adapt & ~passed] = np.minimum(1.0, 1.5 * ptol_factor[adapt & ~passed])
+        ptol[adapt] = presid[adapt] * np.minimum(ptol_factor[adapt],
+                                                 targets[adapt] / rnorm[adapt])
+        active = np.flatnonzero(~converged)
+        if len(active) == 0 or cycle == maxiter:
+            break
+        ran[:] = False
+        ran[active] = True
+
+        m = len(active)
+        basis = np.zeros((restart + 1, size, m))
+        hessenberg = np.zeros((m, restart + 1, restart))
+        cos, sin = np.zeros((m, restart)), np.zeros((m, restart))
+        g = np.zeros((m, restart + 1))
+        preconditioned = precondition(residual[:, active])
+        g[:, 0] = np.linalg.norm(preconditioned, axis=0)
+        basis[0] = preconditioned / np.maximum(g[:, 0], tiny)
+        done = np.zeros(m, dtype=bool)
+        steps = np.zeros(m, dtype=int)
+        for j in range(restart):
+            w = precondition(matvec(basis[j]))
+            before = np.linalg.norm(w, axis=0)
+            # Modified Gram-Schmidt against the basis of each column
+            for i in range(j + 1):
+                h = np.einsum('ij,ij->j', basis[i], w)
+                hessenberg[:, i, j] = h
+                w -= h * basis[i]
+            after = np.linalg.norm(w, axis=0)
+            breakdown = after <= eps * before
+            hessenberg[:, j + 1, j] = np.where(breakdown, 0.0, after)
+            basis[j + 1] = np.where(breakdown, 0.0, w / np.maximum(after, tiny))
+            # Previous Givens rotations, then a new one to zero the subdiagonal
+            for i in range(j):
+                upper = cos[:, i] * hessenberg[:, i, j] + sin[:, i] * hessenberg[:, i + 1, j]
+                hessenberg[:, i + 1, j] = (-sin[:, i] * hessenberg[:, i, j]
+                                           + cos[:, i] * hessenberg[:, i + 1, j])
+                hessenberg[:, i, j] = upper
+            radius = np.hypot(hessenberg[:, j, j], hessenberg[:, j + 1, j])
+            safe = np.maximum(radius, tiny)
+            cos[:, j] = np.where(radius > 0, hessenberg[:, j, j] / safe, 1.0)
+            sin[:, j] = np.where(radius > 0, hessenberg[:, j + 1, j] / safe, 0.0)
+            hessenberg[:, j, j] = radius
+            hessenberg[:, j + 1, j] = 0.0
+            g[:, j + 1] = -sin[:, j] * g[:, j]
+            g[:, j] = cos[:, j] * g[:, j]
+            # Columns that are done keep iterating with the others, but only
+            # the steps up to where they finished are used
+            steps[~done] = j + 1
+            presid[active[~done]] = np.abs(g[~done, j + 1])
+            iterations[active[~done]] += 1
+            done |= (np.abs(g[:, j + 1]) <= ptol[active]) | breakdown
+            if done.all():
+                break
+
+        for c, column in enumerate(active):
+            n_steps = steps[c]
+            diagonal = np.diagonal(hessenberg[c, :n_steps, :n_steps])
+            # Stop at a zero pivot, as scipy's pseudo-solve does
+            rank = n_steps if np.all(diagonal != 0) else int(np.argmin(diagonal != 0))
+            if rank == 0:
+                continue
+            y = solve_triangular(hessenberg[c, :rank, :rank], g[c, :rank])
+            x[:, column] += basis[:rank, :, c].T @ y
+    return x, iterations, converged
+
+
+def _tile_shape(n_points, n_centres, memory_limit, itemsize=8, buffers=3,
+                min_rows=256):
+    """
+    Returns the number of rows (points) and columns (source vertices) of a
+    tile such that the buffers held while evaluating it fit in memory_limit
+    MB. The source vertices are only split when fewer than min_rows points
+    would fit against all of them.
+    """
+    budget = max(int(memory_limit * 2**20 / (buffers * itemsize)), 1)
+    min_rows = max(min(min_rows, n_points), 1)
+    cols = max(n_centres, 1)
+    rows = budget // cols
+    if rows < min_rows:
+        rows = min_rows
+        cols = max(budget // rows, 1)
+    return max(min(rows, n_points), 1), min(cols, max(n_centres, 1))
+
+
+def _evaluate_tile(points, centres, centres_sq, coeffs, RBF):
+    """
+    Returns RBF(|points - centres|) @ coeffs for a tile using one GEMM for
+    the cross term of the squared distances.
+    """
+    dist = np.einsum('ij,ij->i', points, points)[:, np.newaxis] + centres_sq
+    dist += (points * -2.0) @ centres.T
+    np.maximum(dist, 0.0, out=dist)
+    np.sqrt(dist, out=dist)
+    return RBF(dist) @ coeffs
+
+
+def _evaluate_dense(points, centres, coeffs, RBF, memory_limit, out,
+                    dtype=np.float64):
+    """
+    Adds the displacements of points to out, walking the points and centres
+    in tiles that fit in memory_limit MB.
+
+    The distance and RBF tiles are computed in dtype and the result of each
+    tile is accumulated into out in float64. In float32, with unit roundoff
+    u = 2**-24 and R the largest distance of a point or centre from the
+    centroid of the centres, the squared distances carry an error of about
+    6uR^2. A distance d is then out by at most min(sqrt(6u)R, 3uR^2/d), i.e.
+    about 6e-4 R for (near) coincident points and far less elsewhere. For a
+    kernel with Lipschitz constant L the error in a displacement is bounded
+    by sum_j |q_j| (L |dd_j| + n u |RBF(d_j)|) for the n coefficients q_j.
+    """
+    rows, cols = _tile_shape(len(points), len(centres), memory_limit,
+                             itemsize=np.dtype(dtype).itemsize)
+    # Shifting to the centroid of the centres keeps the squared norms small
+    # and so limits cancellation in the distance identity.
+    origin = centres.mean(axis=0)
+    centres = (centres - origin).astype(dtype, copy=False)
+    coeffs = np.asarray(coeffs, dtype=dtype)
+    centres_sq = np.einsum('ij,ij->i', centres, centres)
+    for i in range(0, len(points), rows):
+        tile = (points[i:i + rows] - origin).astype(dtype, copy=False)
+        for j in range(0, len(centres), cols):
+            out[i:i + rows] += _evaluate_tile(
+                tile, centres[j:j + cols], centres_sq[j:j + cols],
+                coeffs[j:j + cols], RBF)
+
+
+def _evaluate_compact(points, tree, coeffs, RBF, neighbours, memory_limit, out):
+    """
+    Adds the displacements of points to out for a compactly supported RBF,
+    using the KD-tree of the centres to only pair points with the centres
+    within the support radius.
+    """
+    rows = max(int(memory_limit * 2**20 / (48 * neighbours)), 1)
+    for i in range(0, len(points), rows):
+        block = points[i:i + rows]
+        pairs = cKDTree(block).sparse_distance_matrix(
+            tree, RBF.support_radius, output_type='ndarray')
+        weights = sparse.csr_matrix(
+            (RBF(pairs['v']), (pairs['i'], pairs['j'])),
+            shape=(len(block), tree.n))
+        out[i:i + rows] += weights @ coeffs
+
+
+class _SharedArray:
+    """A numpy array held in a block of shared memory."""
+    def __init__(self, shm, shape, dtype):
+        self.shm = shm
+        self.array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    @classmethod
+    def create(cls, array):
+        """Copies array into a new block of shared memory."""
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared = cls(shm, array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, spec):
+        """Attaches to an existing block from the spec of its creator."""
+        name, shape, dtype = spec
+        return cls(SharedMemory(name=name), shape, dtype)
+
+    def spec(self):
+        return self.shm.name, self.array.shape, self.array.dtype.str
+
+    def close(self, unlink=False):
+        del self.array
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+# State of each process in the pool, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(specs, RBF, neighbours, memory_limit, dtype):
+    """Attaches a pool process to the shared arrays."""
+    _worker['shared'] = {name: _SharedArray.attach(spec)
+                         for name, spec in specs.items()}
+    _worker['RBF'] = RBF
+    _worker['neighbours'] = neighbours
+    _worker['memory_limit'] = memory_limit
+    _worker['dtype'] = dtype
+    if getattr(RBF, 'support_radius', None) is not None:
+        _worker['tree'] = cKDTree(_worker['shared']['centres'].array)
+
+
+def _displacement_task(start, stop):
+    """Evaluates the displacements of points[start:stop] in a pool process."""
+    arrays = {name: block.array for name, block in _worker['shared'].items()}
+    points = arrays['points'][start:stop]
+    out = arrays['out'][start:stop]
+    if 'tree' in _worker:
+        _evaluate_compact(points, _worker['tree'], arrays['coeffs'],
+                          _worker['RBF'], _worker['neighbours'],
+                          _worker['memory_limit'], out)
+    else:
+        _evaluate_dense(points, arrays['centres'], arrays['coeffs'],
+                        _worker['RBF'], _worker['memory_limit'], out,
+                        _worker['dtype'])
 
 
 def custom_RBF(r):
     return r
+
+
+def cubic_RBF(r):
+    """Conditionally positive definite of order 2, use an affine tail."""
+    return r**3
+
+
+def thin_plate_spline_RBF(r):
+    """
+    r^2 log(r), conditionally positive definite of order 2, use an affine
+    tail.
+    """
+    r = np.asarray(r, dtype=np.result_type(r, np.float32))
+    safe = np.where(r > 0.0, r, 1.0)
+    return r**2 * np.log(safe)
+
+
+class MultiquadricRBF:
+    """
+    sqrt(r^2 + c^2) with shape parameter c, conditionally positive definite
+    of order 1, use at least a constant tail.
+    """
+    def __init__(self, shape_parameter: float=1.0):
+        self.shape_parameter = shape_parameter
+
+    def __call__(self, r):
+        r = np.asarray(r, dtype=np.result_type(r, np.float32))
+        return np.sqrt(r**2 + self.shape_parameter**2)
+
+
+class WendlandRBF:
+    """
+    Wendland's compactly supported radial basis functions, which are positive
+    definite in three dimensions and zero beyond support_radius. This makes
+    the interpolation matrix sparse. smoothness may be 0, 2, 4 or 6 for the
+    C0, C2, C4 and C6 functions.
+    """
+    def __init__(self, support_radius: float, smoothness: int=2):
+        if smoothness not in (0, 2, 4, 6):
+            raise ValueError("Wendland smoothness must be 0, 2, 4 or 6, "
+                             f"{smoothness} was given.")
+        self.support_radius = support_radius
+        self.smoothness = smoothness
+
+    def __call__(self, r):
+        x = np.asarray(r, dtype=np.float64) / self.support_radius
+        t = np.clip(1.0 - x, 0.0, None)
+        if self.smoothness == 0:
+            return t**2
+        if self.smoothness == 2:
+            return t**4 * (4.0*x + 1.0)
+        if self.smoothness == 4:
+            return t**6 * (35.0*x**2 + 18.0*x + 3.0) / 3.0
+        return t**8 * (32.0*x**3 + 25.0*x**2 + 8.0*x + 1.0)
+
+
+
+# Kernels that can be stored in and restored from a morph model
+RBF_KERNELS = {
+    'custom_RBF': custom_RBF,
+    'cubic_RBF': cubic_RBF,
+    'thin_plate_spline_RBF': thin_plate_spline_RBF,
+    'MultiquadricRBF': MultiquadricRBF,
+    'WendlandRBF': WendlandRBF,
+}
+
+
+def _kernel_spec(RBF):
+    """Returns the name and parameters that identify the RBF."""
+    if RBF_KERNELS.get(getattr(RBF, '__name__', None)) is RBF:
+        return {'name': RBF.__name__, 'params': {}}
+    name = type(RBF).__name__
+    if RBF_KERNELS.get(name) is type(RBF):
+        return {'name': name, 'params': dict(vars(RBF))}
+    raise ValueError(f"The RBF {RBF} is not in RBF_KERNELS so it cannot be saved.")
+
+
+def _kernel_from_spec(spec):
+    """Recreates the RBF identified by spec."""
+    kernel = RBF_KERNELS[spec['name']]
+    if isinstance(kernel, type):
+        return kernel(**spec['params'])
+    return kernel
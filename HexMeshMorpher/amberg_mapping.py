@@ -2,21 +2,51 @@
 """
 Performs amberg non-rigid ICP on the trimesh objects of source and target
 objects are returns to the mapping in the mapped object which is returned.
+The registration itself is done by OptimalStepNICP in the nricp module.
+
+The closest point queries on the target go through a TargetIndex, which is
+built once for a target mesh and reused by every mapping onto it, so mapping
+many sources onto the same target template only builds the KD-tree (or the
+triangle tree) once.
 """
 
 import time
+import weakref
 import trimesh as tr
 from HexMeshMorpher.MeshObj import TriMesh
+from HexMeshMorpher.nricp import OptimalStepNICP, TargetIndex
+
+# Indices of the target meshes, kept while the TriMesh objects are alive
+_TARGET_INDICES = weakref.WeakKeyDictionary()
+
+
+def get_target_index(target: TriMesh, use_faces: bool = False) -> TargetIndex:
+    """
+    Returns the index of a target mesh, building it only if the target has
+    no index yet or its geometry has changed since the index was built.
+    """
+    index = _TARGET_INDICES.get(target)
+    if index is None or not index.matches(target.trimesh, use_faces):
+        index = TargetIndex(target.trimesh, use_faces)
+        _TARGET_INDICES[target] = index
+    return index
+
 
 class AmbergMapping:
     """
     Performs amberg non-rigid ICP on the trimesh objects of source and target
     objects and returns to the mapping in the mapped object which is
     returned.
+
+    The index of the target is taken from target_index if given, otherwise
+    the index kept for the target mesh is reused or built. The time taken to
+    build and query the index, assemble the system and solve it is kept in
+    timings. The 'solver' option is 'direct' or 'cg', see OptimalStepNICP.
     """
     def __init__(self, sourcey: TriMesh, targety: TriMesh,
                  mappedy: TriMesh, lpairs: list=None,
-                 steps: list=None, options=None) -> None:
+                 steps: list=None, options=None,
+                 target_index: TargetIndex=None) -> None:
         self.source = sourcey
         self.target = targety
         self.mapped = mappedy
@@ -27,6 +57,9 @@ class AmbergMapping:
             'distance_threshold':0.1,
             'use_faces':False, # Changing to True causes error (installed rtree with pip to solve)
             'use_landmarks':False,
+            'solver':'direct',
+            'solver_tolerance':1e-10, # Relative residual of the CG solver
+            'threads':1, # Threads of the CG solver
         } # Default values
         if options:
             for item in self.ops:
@@ -49,44 +82,63 @@ class AmbergMapping:
         if lpairs:
             self.landmark_pairs = lpairs # [source vertex index, target vertex position vector]
 
+        self.target_index = target_index
+        self.engine = None
+        self.timings = {}
         self.run_amberg()
 
+    def get_target_index(self) -> TargetIndex:
+        """Returns the index of the target, building it if it is out of date."""
+        if self.target_index is None or \
+                not self.target_index.matches(self.target.trimesh, self.ops['use_faces']):
+            self.target_index = get_target_index(self.target, self.ops['use_faces'])
+        return self.target_index
+
     def run_amberg(self):
         """Runs the amberg mapping."""
+        start_time = time.time()
+        print("Performing Amberg Mapping")
+        previous = self.target_index
+        index = self.get_target_index()
+        if index is previous or index.query_count:
+            print("Reusing the target index built in " + str(index.build_time) + "s")
+            build_time = 0.0
+        else:
+            print("Built the target index in " + str(index.build_time) + "s")
+            build_time = index.build_time
+        query_time, query_count = index.query_time, index.query_count
+
+        source_indices, target_points = None, None
         if self.ops['use_landmarks']:
             source_indices = [pair[0] for pair in self.landmark_pairs]
             target_points = [pair[1] for pair in self.landmark_pairs]
-
-            start_time = time.time()
-            print("Performing Amberg Mapping")
-            morphed_vertices \
-                = tr.registration.nricp_amberg(self.source.trimesh,
-                                                self.target.trimesh,
-                                                use_faces=self.ops['use_faces'],
-                                                source_landmarks=source_indices,
-                                                target_positions=target_points,
-                                                steps=self.steps,
-                                                gamma=self.ops['gamma'],
-                                                eps=self.ops['epsilon'],
-                                                neighbors_count=self.ops['neighbors'],
-                                                distance_threshold=self.ops['distance_threshold'])
-            self.mapped.trimesh = tr.Trimesh(vertices=morphed_vertices,
-                                                faces=self.source.trimesh.faces)
-            print("Amberg Mapping Completed in " + str(time.time() - start_time) + "s")
-        else:
-            start_time = time.time()
-            print("Performing Amberg Mapping")
-            morphed_vertices = tr.registration.nricp_amberg(self.source.trimesh,
-                                                            self.target.trimesh,
-                                                            use_faces=self.ops['use_faces'],
-                                                            steps=self.steps,
-                                                            gamma=self.ops['gamma'],
-                                                            eps=self.ops['epsilon'],
-                                                            neighbors_count=self.ops['neighbors'],
-                                                            distance_threshold=self.ops['distance_threshold'])
-            self.mapped.trimesh = tr.Trimesh(vertices=morphed_vertices,
-                                             faces=self.source.trimesh.faces)
-            print("Amberg Mapping Completed in "+str(time.time()-start_time)+"s")
+        self.engine = OptimalStepNICP(self.source.trimesh,
+                                      gamma=self.ops['gamma'],
+                                      source_landmarks=source_indices,
+                                      solver=self.ops['solver'],
+                                      solver_tolerance=self.ops['solver_tolerance'],
+                                      threads=self.ops['threads'])
+        morphed_vertices = self.engine.run(index,
+                                           target_positions=target_points,
+                                           steps=self.steps,
+                                           eps=self.ops['epsilon'],
+                                           neighbors_count=self.ops['neighbors'],
+                                           distance_threshold=self.ops['distance_threshold'])
+        self.mapped.trimesh = tr.Trimesh(vertices=morphed_vertices,
+                                         faces=self.source.trimesh.faces)
+        self.timings = {
+            'index_build': build_time,
+            'index_query': index.query_time - query_time,
+            'queries': index.query_count - query_count,
+            'assembly': self.engine.timings['assembly'],
+            'solve': self.engine.timings['solve'],
+            'total': time.time() - start_time,
+        }
+        print("Target index queried " + str(self.timings['queries']) + " times in "
+              + str(self.timings['index_query']) + "s")
+        print("System assembled in " + str(self.timings['assembly']) + "s and solved ("
+              + self.ops['solver'] + ") in " + str(self.timings['solve']) + "s")
+        print("Amberg Mapping Completed in " + str(self.timings['total']) + "s")
 
 
     def find_vertex_index(self, mesh: TriMesh, vertex):
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+A simple self-describing binary container for numpy arrays, used for the
+files that are shared between the stages of the morphing pipeline.
+
+The file starts with an 8 byte magic string and the length of a JSON header
+as a little-endian uint64. The header holds the user metadata and the dtype,
+shape and offset of each array. The arrays follow, each aligned to 64 bytes,
+so they can be memory-mapped straight from the file without being read.
+"""
+
+import hashlib
+import json
+import numpy as np
+
+MAGIC = b'HMMCONT1'
+ALIGNMENT = 64
+
+
+class ContainerError(Exception):
+    """Error message for reading invalid or corrupted container files."""
+
+    def __init__(self, file_path, message):
+        self.message = f"Cannot read container {file_path}.\n\n{message}\n"
+        super().__init__(self.message)
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_container(file_path, meta: dict, arrays: dict) -> None:
+    """
+    Writes the arrays and the JSON serialisable meta data to file_path. A
+    checksum of the array data is stored in the header.
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    layout = {}
+    offset = 0
+    checksum = hashlib.blake2b(digest_size=16)
+    for name, array in arrays.items():
+        offset = _aligned(offset)
+        layout[name] = {
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+            'offset': offset,
+        }
+        offset += array.nbytes
+        checksum.update(memoryview(array).cast('B'))
+    header = json.dumps({
+        'meta': meta,
+        'arrays': layout,
+        'checksum': checksum.hexdigest(),
+    }).encode('utf-8')
+
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+    with open(file_path, 'wb') as file:
+        file.write(MAGIC)
+        file.write(np.uint64(len(header)).tobytes())
+        file.write(header)
+        for name, array in arrays.items():
+            file.write(b'\0' * (data_start + layout[name]['offset'] - file.tell()))
+            file.write(memoryview(array).cast('B'))
+
+
+def read_container(file_path, mmap_mode: str = None, verify: bool = False):
+    """
+    Reads a container written by write_container, returning its meta data
+    and a dict of its arrays. With mmap_mode ('r', 'r+' or 'c') the arrays
+    are memory-mapped from the file instead of being read into memory. The
+    checksum is only checked when verify is True as it reads all the data.
+    """
+    with open(file_path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ContainerError(file_path, "The file is not a container.")
+        header_length = int(np.frombuffer(file.read(8), dtype='<u8')[0])
+        header = json.loads(file.read(header_length).decode('utf-8'))
+        data_start = _aligned(len(MAGIC) + 8 + header_length)
+
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            shape = tuple(spec['shape'])
+            offset = data_start + spec['offset']
+            count = int(np.prod(shape))
+            if count == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            elif mmap_mode:
+                arrays[name] = np.memmap(file_path, dtype=dtype, mode=mmap_mode,
+                                         offset=offset, shape=shape)
+            else:
+                file.seek(offset)
+                arrays[name] = np.fromfile(file, dtype=dtype, count=count).reshape(shape)
+
+    if verify:
+        checksum = hashlib.blake2b(digest_size=16)
+        for array in arrays.values():
+            checksum.update(memoryview(np.ascontiguousarray(array)).cast('B'))
+        if checksum.hexdigest() != header['checksum']:
+            raise ContainerError(file_path, "The checksum of the data does not match.")
+    return header['meta'], arrays
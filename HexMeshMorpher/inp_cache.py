@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of parsed inp files. The nodes, elements and the text kept for
+writing the file back out are stored in a container file, so a second load
+of the same deck memory-maps the arrays instead of parsing the text again.
+
+Each entry is named after a key made from the absolute path of the inp file,
+its size, its modification time and a hash of its content. Changing the file
+changes the key, so stale entries are never read, and they are removed when
+the new entry is stored. The cache folder is kept under a size limit by removing the least recently
+used entries.
+"""
+
+import os
+import hashlib
+import numpy as np
+from HexMeshMorpher.container import write_container, read_container, ContainerError
+
+CACHE_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'HexMeshMorpher')
+CACHE_VERSION = 2
+# Number and size of the blocks of the file hashed for the content hash
+HASH_BLOCKS = 16
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def content_hash(file_path) -> str:
+    """
+    Hash of the content of a file. Files smaller than HASH_BLOCKS blocks are
+    hashed in full, larger files are sampled at HASH_BLOCKS evenly spaced
+    blocks (including the first and last) so that multi-GB decks are not
+    read in full just to find their key.
+    """
+    size = os.path.getsize(file_path)
+    checksum = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as file:
+        if size <= HASH_BLOCKS * HASH_BLOCK_SIZE:
+            checksum.update(file.read())
+        else:
+            for offset in np.linspace(0, size - HASH_BLOCK_SIZE, HASH_BLOCKS):
+                file.seek(int(offset))
+                checksum.update(file.read(HASH_BLOCK_SIZE))
+    return checksum.hexdigest()
+
+
+def _path_key(file_path) -> str:
+    path = os.path.abspath(file_path).encode('utf-8')
+    return hashlib.blake2b(path, digest_size=8).hexdigest()
+
+
+def cache_key(file_path) -> str:
+    """
+    Key of the cache entry of a file, made of a hash of its path followed by
+    a hash of its size, mtime and content.
+    """
+    stat = os.stat(file_path)
+    state = hashlib.blake2b(digest_size=16)
+    state.update(f"{stat.st_size}:{stat.st_mtime_ns}:{CACHE_VERSION}".encode('utf-8'))
+    state.update(content_hash(file_path).encode('utf-8'))
+    return f"{_path_key(file_path)}-{state.hexdigest()}"
+
+
+def cache_path(file_path, cache_folder: str = None) -> str:
+    cache_folder = cache_folder if cache_folder else CACHE_FOLDER
+    return os.path.join(cache_folder, cache_key(file_path) + '.inpc')
+
+
+def invalidate(file_path, cache_folder: str = None, keep: str = None) -> list:
+    """
+    Removes the cache entries of a file, other than keep. These are the
+    entries of older versions of the file when keep is its current entry.
+    """
+    cache_folder = cache_folder if cache_folder else CACHE_FOLDER
+    if not os.path.isdir(cache_folder):
+        return []
+    prefix = _path_key(file_path) + '-'
+    removed = []
+    for name in os.listdir(cache_folder):
+        path = os.path.join(cache_folder, name)
+        if (name.startswith(prefix) and name.endswith('.inpc')
+                and not (keep and os.path.abspath(path) == os.path.abspath(keep))):
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+
+def load(file_path, cache_folder: str = None):
+    """
+    Returns the cached (meta, arrays) of an inp file, or None if there is no
+    valid entry. The arrays are memory-mapped copy-on-write, so editing them
+    does not change the cache.
+    """
+    path = cache_path(file_path, cache_folder)
+    if not os.path.exists(path):
+        return None
+    try:
+        meta, arrays = read_container(path, mmap_mode='c')
+    except (ContainerError, OSError, ValueError, KeyError) as error:
+        print(f"Removing unreadable cache entry {path}: {error}")
+        os.remove(path)
+        return None
+    if meta.get('version') != CACHE_VERSION:
+        return None
+    # Mark the entry as recently used for the eviction
+    os.utime(path)
+    return meta, arrays
+
+
+def store(file_path, meta: dict, arrays: dict, cache_folder: str = None,
+          max_size: float = 4096.0) -> str:
+    """
+    Writes the cache entry of an inp file and then evicts the least recently
+    used entries until the cache folder is smaller than max_size (MB).
+    """
+    path = cache_path(file_path, cache_folder)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    meta = dict(meta, version=CACHE_VERSION, source=os.path.abspath(file_path))
+    # Write to a temporary file first so a partly written entry is never read
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    write_container(temp_path, meta, arrays)
+    os.replace(temp_path, path)
+    invalidate(file_path, os.path.dirname(path), keep=path)
+    evict(os.path.dirname(path), max_size, keep=path)
+    return path
+
+
+def evict(cache_folder: str = None, max_size: float = 4096.0, keep: str = None) -> list:
+    """
+    Removes the least recently used entries of the cache folder until its
+    total size is below max_size (MB). The entry keep is never removed.
+    Returns the paths of the removed entries.
+    """
+    cache_folder = cache_folder if cache_folder else CACHE_FOLDER
+    if not os.path.isdir(cache_folder):
+        return []
+    entries = []
+    for name in os.listdir(cache_folder):
+        if name.endswith('.inpc'):
+            path = os.path.join(cache_folder, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(entry[1] for entry in entries)
+    removed = []
+    for _, size, path in entries:
+        if total <= max_size * 1024**2:
+            break
+        if keep and os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed.append(path)
+    if removed:
+        print(f"Evicted {len(removed)} entries from the inp cache {cache_folder}")
+    return removed
+
+
+def clear(cache_folder: str = None) -> None:
+    """Removes every entry of the cache folder."""
+    evict(cache_folder, max_size=0.0)
+
+
+def encode_lines(lines) -> np.ndarray:
+    """Encodes a list of lines of text as a uint8 array."""
+    return np.frombuffer(''.join(lines).encode('utf-8'), dtype=np.uint8)
+
+
+def decode_lines(array) -> list:
+    """Decodes a uint8 array written by encode_lines back into lines."""
+    return bytes(array).decode('utf-8').splitlines(keepends=True)
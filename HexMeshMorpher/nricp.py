@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+Optimal step non-rigid ICP of Amberg et al. 2007, following
+trimesh.registration.nricp_amberg but with control over the linear solver.
+
+The normal equations of the registration are assembled once for a source
+mesh on a fixed sparsity pattern. The stiffness and landmark terms do not
+change between iterations, so each iteration only refreshes the 4x4 data
+block of each vertex and the right-hand side. The closest point queries on
+the target go through a TargetIndex, which is built once for a target and
+can be shared between registrations.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import trimesh as tr
+from scipy import sparse
+from scipy.sparse import linalg as sparse_linalg
+from scipy.spatial import cKDTree
+
+# [smoothness weight, landmark weight, normal weight, max iterations] of each step
+DEFAULT_STEPS = [
+    [0.01, 10, 0.5, 10],
+    [0.02, 5, 0.5, 10],
+    [0.03, 2.5, 0.5, 10],
+    [0.01, 0, 0.0, 10],
+]
+
+
+class TargetIndex:
+    """
+    Nearest point queries on a target mesh. The KD-tree of the vertices, or
+    the triangle tree when use_faces is True, is built once when the index
+    is created. The index keeps its own copy of the target, so changing the
+    target mesh afterwards does not change the index; use matches to check
+    that it is still up to date.
+
+    build_time is the time taken to build the index, query_time and
+    query_count add up the time and number of queries made through it.
+    """
+    def __init__(self, target: tr.Trimesh, use_faces: bool = False) -> None:
+        start_time = time.time()
+        self.use_faces = use_faces
+        self.key = (hash(target.vertices), hash(target.faces))
+        self.mesh = tr.Trimesh(vertices=np.array(target.vertices, dtype=np.float64),
+                               faces=np.array(target.faces), process=False)
+        self.vertices = self.mesh.vertices.view(np.ndarray)
+        self.kdtree = cKDTree(self.vertices)
+        self.proximity = None
+        if use_faces and len(self.mesh.faces) > 0:
+            self.proximity = tr.proximity.ProximityQuery(self.mesh)
+            # Build the cached trees and normals now rather than on the first query
+            _ = self.mesh.triangles_tree
+            _ = self.mesh.face_normals
+            _ = self.mesh.vertex_normals
+        self.build_time = time.time() - start_time
+        self.query_time = 0.0
+        self.query_count = 0
+
+    def matches(self, target: tr.Trimesh, use_faces: bool = False) -> bool:
+        """Checks whether the index was built from this target geometry."""
+        return (self.use_faces == use_faces
+                and self.key == (hash(target.vertices), hash(target.faces)))
+
+    def query(self, points, return_normals: bool = False,
+              return_interpolated_normals: bool = False,
+              neighbors_count: int = 8) -> dict:
+        """
+        Finds the closest points of the target to the points. Returns a dict
+        with the 'nearest' points and their 'distances', and the 'normals'
+        (and 'interpolated_normals' when using the faces) if asked for, as
+        in trimesh.registration.
+        """
+        start_time = time.time()
+        points = np.asarray(points, dtype=np.float64)
+        result = {}
+        if self.proximity is None:
+            neighbors_count = min(neighbors_count, len(self.vertices))
+            if return_normals and neighbors_count >= 3:
+                distances, indices = self.kdtree.query(points, k=neighbors_count)
+                nearest = self.vertices[indices]
+                result['normals'] = plane_normals(nearest)
+                result['nearest'] = nearest[:, 0]
+                result['distances'] = distances[:, 0]
+            else:
+                result['distances'], indices = self.kdtree.query(points)
+                result['nearest'] = self.vertices[indices]
+        else:
+            nearest, distances, face_ids = self.proximity.on_surface(points)
+            result['nearest'], result['distances'] = nearest, distances
+            if return_normals:
+                result['normals'] = self.mesh.face_normals[face_ids]
+            if return_interpolated_normals:
+                corners = self.mesh.faces[face_ids]
+                barycentric = tr.triangles.points_to_barycentric(
+                    self.vertices[corners], nearest)
+                result['interpolated_normals'] = np.einsum(
+                    'ij,ijk->ik', barycentric, self.mesh.vertex_normals[corners])
+        self.query_time += time.time() - start_time
+        self.query_count += 1
+        return result
+
+
+def plane_normals(points) -> np.ndarray:
+    """
+    Normals of the planes fitted to each (k, 3) group of an (n, k, 3) array
+    of points, as the direction of least variance of each group.
+    """
+    centred = points - points.mean(axis=1, keepdims=True)
+    _, _, vh = np.linalg.svd(centred, full_matrices=False)
+    return vh[:, -1]
+
+
+class OptimalStepNICP:
+    """
+    Optimal step non-rigid ICP of a source mesh. The unknowns are a 4x3
+    affine transform per vertex, found by solving the normal equations of
+    the stiffness, data and landmark terms (Eq. 12) at every iteration.
+
+    The source is normalised by its centroid and scale as in trimesh. The
+    system is assembled on a fixed sparsity pattern when the object is
+    created, so the same object can register the source onto any number of
+    targets. The solver is either
+    - 'direct': SuperLU. The fill-reducing column ordering of the first
+      factorisation is kept and reused by every later factorisation, as
+      the pattern never changes.
+    - 'cg': conjugate gradients with a block Jacobi preconditioner, warm
+      started from the transforms of the previous iteration and step. The
+      three columns of the transforms are solved on up to threads threads.
+
+    The time spent assembling, querying the target and solving is kept in
+    timings and the iterations of the CG solves in solver_info.
+    """
+    def __init__(self, source_mesh: tr.Trimesh, gamma: float = 1,
+                 source_landmarks=None, solver: str = 'direct',
+                 solver_tolerance: float = 1e-10, threads: int = 1) -> None:
+        if solver not in ('direct', 'cg'):
+            raise ValueError(f"Unknown solver {solver}, use 'direct' or 'cg'.")
+        start_time = time.time()
+        self.solver = solver
+        self.solver_tolerance = solver_tolerance
+        self.threads = threads
+        self.solver_info = []
+        self.centroid = np.array(source_mesh.centroid)
+        self.scale = float(source_mesh.scale)
+        vertices = (np.asarray(source_mesh.vertices) - self.centroid) / self.scale
+        n = len(vertices)
+        self.size = 4 * n
+        # Homogeneous coordinates of the vertices, the rows of D (Eq. 8)
+        self.homogeneous = np.hstack([vertices, np.ones((n, 1))])
+        # As in trimesh the normals also pick up the translations
+        self.normals = np.hstack([np.asarray(source_mesh.vertex_normals), np.ones((n, 1))])
+        # Data block of each vertex, the outer product of its coordinates
+        self.outer = np.einsum('ni,nj->nij', self.homogeneous, self.homogeneous).reshape(n, 16)
+
+        # Node-arc incidence matrix weighted by the inverse edge lengths
+        # (Eq. 10), with each edge of each face as in trimesh
+        edges = source_mesh.edges
+        weights = 1 / np.linalg.norm(vertices[edges[:, 0]] - vertices[edges[:, 1]], axis=1)
+        incidence = sparse.csr_matrix(
+            (np.stack([weights, -weights], axis=1).ravel(),
+             (np.repeat(np.arange(len(edges)), 2), edges.ravel())),
+            shape=(len(edges), n))
+        laplacian = (incidence.T @ incidence).tocoo()
+        # kron(M, G)^T kron(M, G) = kron(M^T M, G^2)
+        g2 = np.array([1.0, 1.0, 1.0, gamma])**2
+        stiffness_rows = (4 * laplacian.row[:, None] + np.arange(4)).ravel()
+        stiffness_cols = (4 * laplacian.col[:, None] + np.arange(4)).ravel()
+        stiffness_values = (laplacian.data[:, None] * g2).ravel()
+        block = 4 * np.arange(n)[:, None, None]
+        block_rows = (block + np.arange(4)[:, None] + 0 * np.arange(4)).ravel()
+        block_cols = (block + 0 * np.arange(4)[:, None] + np.arange(4)).ravel()
+
+        # Compressed column pattern of the system. Every entry of the
+        # stiffness term lies in a vertex block or on an edge.
+        position = (np.concatenate([stiffness_cols, block_cols]).astype(np.int64) * self.size
+                    + np.concatenate([stiffness_rows, block_rows]))
+        position, inverse = np.unique(position, return_inverse=True)
+        self.indices = (position % self.size).astype(np.int32)
+        self.indptr = np.concatenate(
+            [[0], np.cumsum(np.bincount(position // self.size, minlength=self.size))]
+        ).astype(np.int32)
+        self.stiffness = np.bincount(inverse[:len(stiffness_values)],
+                                     weights=stiffness_values, minlength=len(position))
+        self.block_positions = inverse[len(stiffness_values):].reshape(n, 16)
+        self.column_order = None
+
+        # The landmark term only depends on which vertices are landmarks
+        self.landmarks = None
+        self.landmark_blocks = np.zeros((n, 16))
+        if source_landmarks is not None and len(source_landmarks):
+            self.landmarks = np.asarray(source_landmarks, dtype=np.int64)
+            np.add.at(self.landmark_blocks, self.landmarks, self.outer[self.landmarks])
+
+        self.transforms = identity_transforms(n)
+        self.timings = {'assembly': time.time() - start_time, 'query': 0.0, 'solve': 0.0}
+
+    def apply_transforms(self, homogeneous) -> np.ndarray:
+        """Moves homogeneous (n, 4) points of the source by the transforms."""
+        return np.einsum('ni,nij->nj', homogeneous, self.transforms.reshape(-1, 4, 3))
+
+    def run(self, target_index: TargetIndex, target_positions=None, steps=None,
+            eps: float = 0.0001, distance_threshold: float = 0.1,
+            use_vertex_normals: bool = True, neighbors_count: int = 8) -> np.ndarray:
+        """
+        Registers the source onto the target of the index, starting from the
+        identity transforms, and returns the mapped source vertices. The
+        target positions of the landmarks are given in the coordinates of
+        the target.
+        """
+        steps = DEFAULT_STEPS if steps is None else steps
+        centroid, scale = self.centroid, self.scale
+        use_faces = target_index.proximity is not None
+        landmark_rhs = np.zeros((len(self.homogeneous), 4, 3))
+        use_landmarks = self.landmarks is not None and target_positions is not None
+        if use_landmarks:
+            positions = (np.asarray(target_positions, dtype=np.float64) - centroid) / scale
+            np.add.at(landmark_rhs, self.landmarks,
+                      self.homogeneous[self.landmarks, :, None] * positions[:, None, :])
+        landmark_rhs = landmark_rhs.reshape(self.size, 3)
+
+        self.transforms = identity_transforms(len(self.homogeneous))
+        self.solver_info = []
+        transformed = self.apply_transforms(self.homogeneous)
+        for ws, wl, wn, max_iter in steps:
+            wl = wl if use_landmarks else 0
+            # Normals can not be estimated from less than 3 neighbouring points
+            if not use_faces and neighbors_count < 3:
+                wn = 0
+            last_error = np.finfo(np.float32).max
+            error = np.finfo(np.float16).max
+            iteration = 0
+            while last_error - error > eps and (max_iter is None or iteration < max_iter):
+                start_time = time.time()
+                query = target_index.query(
+                    transformed * scale + centroid,
+                    return_normals=wn > 0,
+                    return_interpolated_normals=wn > 0 and use_vertex_normals,
+                    neighbors_count=neighbors_count)
+                nearest = (query['nearest'] - centroid) / scale
+                self.timings['query'] += time.time() - start_time
+
+                vertices_weight = np.ones(len(nearest))
+                vertices_weight[query['distances'] / scale > distance_threshold] = 0
+                if wn > 0 and 'normals' in query:
+                    target_normals = query['normals']
+                    if use_vertex_normals and 'interpolated_normals' in query:
+                        target_normals = query['interpolated_normals']
+                    source_normals = self.apply_transforms(self.normals)
+                    dot = np.einsum('ij,ij->i', source_normals, target_normals)
+                    # The orientation of the normals is only known for meshes
+                    dot = np.clip(dot, 0, 1) if use_faces else np.abs(dot)
+                    vertices_weight = vertices_weight * dot**wn
+
+                start_time = time.time()
+                self.transforms = self.solve(ws, wl, vertices_weight, nearest, landmark_rhs)
+                self.timings['solve'] += time.time() - start_time
+                transformed = self.apply_transforms(self.homogeneous)
+
+                last_error = error
+                error = (np.linalg.norm(nearest - transformed, axis=1) * vertices_weight).mean()
+                iteration += 1
+
+        return transformed * scale + centroid
+
+    def solve(self, ws: float, wl: float, vertices_weight, nearest, landmark_rhs) -> np.ndarray:
+        """
+        Solves the normal equations of one iteration (Eq. 12) for the (4n, 3)
+        transforms.
+        """
+        weight2 = vertices_weight**2
+        data = ws**2 * self.stiffness
+        data[self.block_positions] += weight2[:, None] * self.outer + wl**2 * self.landmark_blocks
+        rhs = (self.homogeneous[:, :, None] * (weight2[:, None] * nearest)[:, None, :])
+        rhs = rhs.reshape(self.size, 3) + wl**2 * landmark_rhs
+        matrix = sparse.csc_matrix((data, self.indices, self.indptr),
+                                   shape=(self.size, self.size))
+        if self.solver == 'cg':
+            return self._cg_solve(matrix, data, rhs)
+        if self.column_order is None:
+            factor = sparse_linalg.splu(matrix, permc_spec='COLAMD')
+            self.column_order = factor.perm_c
+            return factor.solve(rhs)
+        # Reorder the columns as in the first factorisation
+        order = self.column_order
+        factor = sparse_linalg.splu(matrix[:, np.argsort(order)], permc_spec='NATURAL')
+        return factor.solve(rhs)[order]
+
+    def _cg_solve(self, matrix, data, rhs) -> np.ndarray:
+        """
+        Solves the system with conjugate gradients, one solve per column of
+        the transforms, warm started from the current transforms and
+        preconditioned by the inverses of the 4x4 vertex blocks.
+        """
+        blocks = data[self.block_positions].reshape(-1, 4, 4)
+        try:
+            inverses = np.linalg.inv(blocks)
+        except np.linalg.LinAlgError:
+            inverses = np.linalg.pinv(blocks)
+        # Block diagonal matrix of the inverses, in CSR with four entries a row
+        columns = (4 * np.arange(len(blocks))[:, None, None]
+                   + np.zeros((1, 4, 1), dtype=np.int64) + np.arange(4))
+        preconditioner = sparse.csr_matrix(
+            (inverses.ravel(), columns.ravel(), np.arange(0, 4 * self.size + 1, 4)),
+            shape=matrix.shape)
+        # The matrix is symmetric, so its transpose is the same matrix in CSR
+        operator = matrix.T
+
+        def solve_column(i):
+            iterations = []
+            column, info = sparse_linalg.cg(
+                operator, rhs[:, i], x0=self.transforms[:, i], M=preconditioner,
+                rtol=self.solver_tolerance, callback=iterations.append)
+            return column, info, len(iterations)
+
+        columns = range(rhs.shape[1])
+        if self.threads > 1:
+            with ThreadPoolExecutor(max_workers=min(self.threads, len(columns))) as executor:
+                results = list(executor.map(solve_column, columns))
+        else:
+            results = [solve_column(i) for i in columns]
+        for i, (_, info, iterations) in enumerate(results):
+            if info != 0:
+                print(f"CG did not converge for component {i} (info = {info})")
+            self.solver_info.append({'iterations': iterations, 'converged': info == 0})
+        return np.column_stack([result[0] for result in results])
+
+
+def identity_transforms(n: int) -> np.ndarray:
+    """(4n, 3) transforms that leave n vertices where they are (Eq. 1)."""
+    return np.tile(np.vstack([np.eye(3), np.zeros((1, 3))]), (n, 1))
+
+
+def nricp_amberg(source_mesh: tr.Trimesh, target_index: TargetIndex,
+                 source_landmarks=None, target_positions=None, steps=None,
+                 eps: float = 0.0001, gamma: float = 1,
+                 distance_threshold: float = 0.1, use_vertex_normals: bool = True,
+                 neighbors_count: int = 8, solver: str = 'direct',
+                 solver_tolerance: float = 1e-10, threads: int = 1) -> np.ndarray:
+    """
+    Optimal step non-rigid ICP with the same arguments as
+    trimesh.registration.nricp_amberg, but with the target given as a
+    prebuilt TargetIndex. Returns the mapped vertices of the source.
+    """
+    engine = OptimalStepNICP(source_mesh, gamma=gamma, source_landmarks=source_landmarks,
+                             solver=solver, solver_tolerance=solver_tolerance,
+                             threads=threads)
+    return engine.run(target_index, target_positions=target_positions, steps=steps,
+                      eps=eps, distance_threshold=distance_threshold,
+                      use_vertex_normals=use_vertex_normals,
+                      neighbors_count=neighbors_count)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Reading and writing of STL files with whole-array numpy operations.
+
+Binary STL files are written and read as a single structured array of
+facets. ASCII files are still supported, for when a human readable file is
+wanted, but they are several times larger and slower in both directions.
+"""
+
+import re
+import numpy as np
+import trimesh as tr
+
+# Layout of a facet of a binary STL file, after the 80 byte header and the
+# uint32 number of facets
+FACET_DTYPE = np.dtype([
+    ('normal', '<f4', (3,)),
+    ('vertices', '<f4', (3, 3)),
+    ('attributes', '<u2'),
+])
+HEADER_SIZE = 84
+VERTEX_PATTERN = re.compile(rb'vertex\s+(\S+)\s+(\S+)\s+(\S+)')
+# Formatting of an ASCII facet, the normal followed by the three vertices
+ASCII_FACET = ('  facet normal %g %g %g\n'
+               '    outer loop\n'
+               '      vertex %r %r %r\n'
+               '      vertex %r %r %r\n'
+               '      vertex %r %r %r\n'
+               '    endloop\n'
+               '  endfacet\n')
+
+
+def face_normals(triangles) -> np.ndarray:
+    """
+    Unit normals of an (n, 3, 3) array of triangles, by the right hand rule.
+    Degenerate triangles get a zero normal.
+    """
+    triangles = np.asarray(triangles, dtype=np.float64)
+    normals = np.cross(triangles[:, 1] - triangles[:, 0],
+                       triangles[:, 2] - triangles[:, 0])
+    magnitude = np.linalg.norm(normals, axis=1, keepdims=True)
+    np.divide(normals, magnitude, out=normals, where=magnitude > 0)
+    normals[magnitude[:, 0] == 0] = 0.0
+    return normals
+
+
+def write_stl(file_path, triangles, normals=None, binary: bool = True,
+              name: str = '', chunk_size: int = 65536) -> None:
+    """
+    Writes an (n, 3, 3) array of triangles to an STL file, as a binary file
+    by default. The normals are calculated if they are not given.
+    """
+    triangles = np.asarray(triangles)
+    if normals is None:
+        normals = face_normals(triangles)
+    if binary:
+        facets = np.zeros(len(triangles), dtype=FACET_DTYPE)
+        facets['normal'] = normals
+        facets['vertices'] = triangles
+        # Binary headers must not start with 'solid', which many readers
+        # take to mean an ASCII file
+        header = f'binary STL {name}'.encode('utf-8')[:80].ljust(80, b' ')
+        with open(file_path, 'wb') as file:
+            file.write(header)
+            file.write(np.uint32(len(facets)).astype('<u4').tobytes())
+            facets.tofile(file)
+        return
+    rows = np.concatenate([np.asarray(normals, dtype=np.float64),
+                           triangles.reshape(-1, 9).astype(np.float64)], axis=1)
+    with open(file_path, 'w', encoding='utf-8', buffering=1 << 20) as file:
+        file.write(f'solid {name}\n')
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            file.write((ASCII_FACET * len(chunk)) % tuple(chunk.ravel().tolist()))
+        file.write(f'endsolid {name}\n')
+
+
+def is_binary(file_path) -> bool:
+    """
+    Checks whether an STL file is binary, from its size matching the number
+    of facets in its header. ASCII files starting with 'solid' can not
+    match this size unless they are corrupt.
+    """
+    with open(file_path, 'rb') as file:
+        header = file.read(HEADER_SIZE)
+        file.seek(0, 2)
+        size = file.tell()
+    if len(header) < HEADER_SIZE:
+        return False
+    count = int(np.frombuffer(header[80:84], dtype='<u4')[0])
+    return size == HEADER_SIZE + count * FACET_DTYPE.itemsize
+
+
+def read_triangles(file_path) -> np.ndarray:
+    """Reads the (n, 3, 3) triangles of a binary or ASCII STL file."""
+    if is_binary(file_path):
+        facets = np.fromfile(file_path, dtype=FACET_DTYPE, offset=HEADER_SIZE)
+        return facets['vertices'].astype(np.float64)
+    with open(file_path, 'rb') as file:
+        data = file.read()
+    vertices = np.array(VERTEX_PATTERN.findall(data)).astype(np.float64)
+    return vertices.reshape(-1, 3, 3)
+
+
+def merge_vertices(triangles):
+    """
+    Merges the identical corners of an (n, 3, 3) array of triangles. Returns
+    the vertices, in the order they are first used, and the (n, 3) faces.
+    """
+    # Adding zero turns -0.0 into 0.0 so they are merged
+    corners = np.asarray(triangles, dtype=np.float64).reshape(-1, 3) + 0.0
+    if len(corners) == 0:
+        return corners, np.zeros((0, 3), dtype=np.int64)
+    # Sort the corners by their coordinates, compared as exact bit patterns,
+    # so identical corners end up next to each other
+    bits = corners.view(np.uint64)
+    order = np.lexsort((bits[:, 2], bits[:, 1], bits[:, 0]))
+    sorted_bits = bits[order]
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = np.any(sorted_bits[1:] != sorted_bits[:-1], axis=1)
+    inverse = np.empty(len(order), dtype=np.int64)
+    inverse[order] = np.cumsum(starts) - 1
+    # The sort is stable, so the first of each group is its first use
+    first = order[starts]
+    # Renumber the vertices in order of first use
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return corners[first[order]], rank[inverse].reshape(-1, 3)
+
+
+def load_stl(file_path) -> tr.Trimesh:
+    """
+    Loads an STL file as a trimesh. The identical corners of the facets are
+    merged here, so trimesh does not need to process the mesh again.
+    """
+    vertices, faces = merge_vertices(read_triangles(file_path))
+    return tr.Trimesh(vertices=vertices, faces=faces, process=False)
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Barycentric Lagrange treecode for the fast approximate evaluation of sums of
+global radial basis functions,
+
+    u(x) = sum_i q_i RBF(|x - y_i|),
+
+at many target points x. The centres y_i are held in an octree and far away
+clusters of centres are replaced by (degree + 1)^3 Chebyshev proxy points
+carrying interpolated charges. As the interpolation only needs the RBF to be
+smooth away from the cluster, any kernel can be used, which brings the cost
+of an evaluation to roughly O((m + n) log n).
+"""
+
+import time
+import numpy as np
+from scipy.spatial.distance import cdist
+
+
+class TreeCode:
+    """
+    Treecode approximation of the RBF displacement field defined by the
+    centres and coeffs. The tolerance is the target error of the
+    approximation relative to sum_i |q_i| |RBF(|x - y_i|)|, and it sets the
+    degree of the interpolation used for the far field. theta is the
+    multipole acceptance criterion, a cluster of centres is treated as far
+    from a batch of points when the sum of their radii is smaller than theta
+    times the distance between their middles.
+    """
+    def __init__(self, centres, coeffs, RBF, tolerance: float=1e-6,
+                 theta: float=0.7, leaf_size: int=None, batch_size: int=256,
+                 degree: int=None):
+        start_time = time.time()
+        self.RBF = RBF
+        self.tolerance = tolerance
+        self.theta = theta
+        self.batch_size = batch_size
+        if degree is None:
+            # The far field error falls by about five times per degree
+            degree = int(np.clip(np.ceil(-np.log(tolerance) / np.log(5.0)) - 3, 2, 12))
+        self.degree = degree
+        self.n_proxies = (degree + 1)**3
+        if leaf_size is None:
+            leaf_size = max(self.n_proxies, 64)
+        self.leaf_size = leaf_size
+
+        centres = np.asarray(centres, dtype=np.float64)
+        coeffs = np.asarray(coeffs, dtype=np.float64)
+        nodes, order = build_octree(centres, leaf_size)
+        self.order = order
+        self.centres = centres[order]
+        self.coeffs = coeffs[order]
+        self.nodes = nodes
+
+        # Chebyshev points of the second kind and their barycentric weights
+        k = np.arange(degree + 1)
+        self._cheb = np.cos(np.pi * k / degree)
+        self._weights = (-1.0)**k
+        self._weights[[0, -1]] *= 0.5
+
+        for node in self.nodes:
+            if node['end'] - node['start'] > self.n_proxies:
+                self._set_proxies(node)
+        print(f"Treecode of degree {degree} with {len(self.nodes)} clusters "
+              f"built in {time.time() - start_time:.2f}s")
+
+    def _set_proxies(self, node):
+        """
+        Sets the Chebyshev proxy points of a cluster and their charges, which
+        are found by interpolating the coefficients of the cluster onto them.
+        """
+        lower, upper = node['lower'], node['upper']
+        half = 0.5 * (upper - lower)
+        middle = 0.5 * (upper + lower)
+        points = self.centres[node['start']:node['end']]
+        charges = self.coeffs[node['start']:node['end']]
+
+        # Lagrange basis of each coordinate at the centres of the cluster
+        basis = [self._lagrange((points[:, d] - middle[d]) / half[d])
+                 for d in range(3)]
+        nodes_1d = [middle[d] + half[d] * self._cheb for d in range(3)]
+        grid = np.stack(np.meshgrid(*nodes_1d, indexing='ij'), axis=-1)
+        node['proxies'] = grid.reshape(-1, 3)
+        node['basis'] = basis
+        node['proxy_charges'] = self._proxy_charges(basis, charges)
+
+    def _proxy_charges(self, basis, charges):
+        proxy_charges = np.einsum('ia,ib,ic,ij->abcj', *basis, charges)
+        return proxy_charges.reshape(-1, charges.shape[1])
+
+    def set_coeffs(self, coeffs):
+        """
+        Replaces the coefficients, keeping the clusters and their proxy
+        points, so the same tree can apply the RBFs to new coefficients.
+        """
+        self.coeffs = np.asarray(coeffs, dtype=np.float64)[self.order]
+        for node in self.nodes:
+            if 'proxies' in node:
+                node['proxy_charges'] = self._proxy_charges(
+                    node['basis'], self.coeffs[node['start']:node['end']])
+
+    def _lagrange(self, x):
+        """Values of the 1D Lagrange basis at x in [-1, 1] (len(x), degree + 1)."""
+        diff = x[:, np.newaxis] - self._cheb[np.newaxis, :]
+        exact = diff == 0.0
+        diff[exact] = 1.0
+        basis = self._weights / diff
+        basis /= basis.sum(axis=1, keepdims=True)
+        rows = exact.any(axis=1)
+        basis[rows] = exact[rows]
+        return basis
+
+    def plan(self, points):
+        """
+        Splits the points into batches and finds the near centres and the
+        far clusters of each batch. A plan can be passed to evaluate to
+        apply the tree to the same points many times, e.g. in an iterative
+        solver, without walking the tree again.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        batches, order = build_octree(points, self.batch_size, leaves_only=True)
+        sorted_points = points[order]
+        plan = []
+        for batch in batches:
+            targets = sorted_points[batch['start']:batch['end']]
+            middle = 0.5 * (batch['lower'] + batch['upper'])
+            radius = 0.5 * np.linalg.norm(batch['upper'] - batch['lower'])
+
+            near, far = [], []
+            stack = [0]
+            while stack:
+                node = self.nodes[stack.pop()]
+                distance = np.linalg.norm(node['middle'] - middle)
+                if ('proxies' in node
+                        and radius + node['radius'] < self.theta * distance):
+                    far.append(node)
+                elif node['children']:
+                    stack.extend(node['children'])
+                else:
+                    near.append(slice(node['start'], node['end']))
+            near = (np.concatenate([np.arange(s.start, s.stop) for s in near])
+                    if near else None)
+            plan.append((order[batch['start']:batch['end']], targets, near, far))
+        return plan
+
+    def evaluate(self, points, out=None, plan=None):
+        """Returns the approximated sum of the RBFs at each of the points."""
+        start_time = time.time()
+        points = np.asarray(points, dtype=np.float64)
+        if out is None:
+            out = np.zeros((len(points), self.coeffs.shape[1]))
+        if len(points) == 0:
+            return out
+        verbose = plan is None
+        if plan is None:
+            plan = self.plan(points)
+        far_count = 0
+        for indices, targets, near, far in plan:
+            result = np.zeros((len(targets), self.coeffs.shape[1]))
+            if near is not None:
+                result += self.RBF(cdist(targets, self.centres[near])) @ self.coeffs[near]
+            if far:
+                far_count += len(far)
+                proxies = np.concatenate([node['proxies'] for node in far])
+                charges = np.concatenate([node['proxy_charges'] for node in far])
+                result += self.RBF(cdist(targets, proxies)) @ charges
+            out[indices] = result
+        # A reused plan is for repeated products, which would flood the output
+        if verbose:
+            print(f"Treecode evaluated {len(points)} points using {far_count} "
+                  f"far field interactions in {time.time() - start_time:.2f}s")
+        return out
+
+
+def build_octree(points, leaf_size, leaves_only=False):
+    """
+    Builds an octree over points. Returns a list of nodes, each a dict
+    holding the range [start, end) of the node in the sorted points, the
+    tight bounding box of those points, its radius and the indices of its
+    children, and the order that sorts the points.
+    """
+    order = np.arange(len(points))
+    nodes = []
+    stack = [(0, len(points), None)]
+    while stack:
+        start, end, parent = stack.pop()
+        coords = points[order[start:end]]
+        lower = coords.min(axis=0)
+        upper = coords.max(axis=0)
+        # Keep boxes of flat clusters from becoming degenerate
+        extent = np.maximum(upper - lower, 1e-9 * max(np.max(upper - lower), 1.0))
+        upper = lower + extent
+        node = {
+            'start': start, 'end': end,
+            'lower': lower, 'upper': upper,
+            'middle': 0.5 * (lower + upper),
+            'radius': 0.5 * np.linalg.norm(extent),
+            'children': [],
+        }
+        index = len(nodes)
+        nodes.append(node)
+        if parent is not None:
+            nodes[parent]['children'].append(index)
+        if end - start <= leaf_size:
+            continue
+
+        # Split into octants about the middle of the box
+        octant = ((coords > node['middle']) * np.array([1, 2, 4])).sum(axis=1)
+        sort = np.argsort(octant, kind='stable')
+        order[start:end] = order[start:end][sort]
+        bounds = np.searchsorted(octant[sort], np.arange(9)) + start
+        children = [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+        if len(children) == 1:
+            # All the points are coincident
+            continue
+        for a, b in children:
+            stack.append((a, b, index))
+
+    if leaves_only:
+        nodes = [node for node in nodes if not node['children']]
+    return nodes, order
@@ -675,11 +675,11 @@ class RBF_Morpher(QMainWindow):
         self.generate_coefficients_btn.clicked.connect(self.generate_coefficients)
         self.main_layout.addWidget(self.generate_coefficients_btn)
         # Button to save the coefficient matrix
-        self.save_coefficients_btn = QPushButton("Save Coefficient Matrix")
+        self.save_coefficients_btn = QPushButton("Save Morph Model")
         self.save_coefficients_btn.clicked.connect(self.save_coefficients)
         self.main_layout.addWidget(self.save_coefficients_btn)
         # Button to load the coefficient matrix
-        self.load_coefficients_btn = QPushButton("Load Coefficient Matrix")
+        self.load_coefficients_btn = QPushButton("Load Morph Model")
         self.load_coefficients_btn.clicked.connect(self.load_coefficients)
         self.main_layout.addWidget(self.load_coefficients_btn)
 
@@ -693,6 +693,8 @@ class RBF_Morpher(QMainWindow):
         self.morph_option_box = QHBoxLayout()
         self.use_multithread_check = QCheckBox("Use Multi-Thread RBF")
         self.morph_option_box.addWidget(self.use_multithread_check)
+        self.use_threads_check = QCheckBox("Use Thread Pool RBF")
+        self.morph_option_box.addWidget(self.use_threads_check)
         self.use_vectorised_displacement_calc = QCheckBox("Use Vectorised Displacement")
         self.use_vectorised_displacement_calc.setChecked(True)
         self.morph_option_box.addWidget(self.use_vectorised_displacement_calc)
@@ -725,36 +727,36 @@ class RBF_Morpher(QMainWindow):
         self.morpher.generate_coefficient_matrix()
 
     def save_coefficients(self):
-        """ Saves the coefficient matrix to a file. """
+        """ Saves the coefficient matrix and everything needed to morph to a morph model file. """
         if self.morpher.coeff_matrix is None:
             show_message(message="You need to generate the coefficient matrix first!",
                          title="Coefficient Matrix Error")
             return
         fname = QFileDialog.getSaveFileName(self,
-                                            "Save Coefficient Matrix",
+                                            "Save Morph Model",
                                             directory=self.WDIR,
-                                            filter="Coefficient Matrix (*.npy)")
+                                            filter="Morph Model (*.morph)")
         if fname[0] == '':
-            show_message(message="Coefficient matrix has not been saved!",
-                         title="Coefficient Matrix Save Error")
+            show_message(message="Morph model has not been saved!",
+                         title="Morph Model Save Error")
             return
-        self.morpher.save_coefficient_matrix(fname[0])
+        self.morpher.save_morph_model(fname[0])
 
     def load_coefficients(self):
-        """ Loads the coefficient matrix from a file. """
+        """ Loads a morph model from a file. """
         fname = QFileDialog.getOpenFileName(self,
-                                            "Load Coefficient Matrix",
+                                            "Load Morph Model",
                                             directory=self.WDIR,
-                                            filter="Coefficient Matrix (*.npy)")
+                                            filter="Morph Model (*.morph)")
         if fname[0] == '':
-            show_message(message="Coefficient matrix has not been loaded!",
-                         title="Coefficient Matrix Load Error")
+            show_message(message="Morph model has not been loaded!",
+                         title="Morph Model Load Error")
             return
         try:
-            self.morpher.load_coefficient_matrix(fname[0])
+            self.morpher.load_morph_model(fname[0])
         except Exception as e:
-            show_message(message=f"Error loading coefficient matrix: {e}",
-                         title="Coefficient Matrix Load Error")
+            show_message(message=f"Error loading morph model: {e}",
+                         title="Morph Model Load Error")
             return
 
     def initiate_morph(self):
@@ -774,6 +776,11 @@ class RBF_Morpher(QMainWindow):
         else:
             self.morpher.use_multithread = False
 
+        if self.use_threads_check.isChecked():
+            self.morpher.execution = 'threads'
+        else:
+            self.morpher.execution = None
+
         if self.use_vectorised_displacement_calc.isChecked():
             self.morpher.use_vectorised = True
         else:
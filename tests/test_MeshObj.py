@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import trimesh as tr
+from HexMeshMorpher import inp_cache
+from HexMeshMorpher.MeshObj import INPMesh, TriMesh, order_boundary_loops
+
+INP_TEXT = """*Heading
+** Job name: test Model name: test
+*Part, name=PART-1
+*Node
+      1,  0.0,  0.0,  0.0
+      2,  2.0,  0.0,  0.0
+      3,  0.0,  2.0,  0.0
+      4,  0.0,  0.0,  2.0
+** a comment inside the nodes
+      5,  2.0,  2.0,  2.0
+*Element, type=C3D10
+1, 1, 2, 3, 4, 1, 2, 3, 4, 1, 2, 3, 4, 1, 2, 3,
+4, 5
+2, 2, 3, 4, 5, 2, 3, 4, 5, 2, 3, 4, 5, 2, 3, 4,
+5, 1
+*Nset, nset=ALL, generate
+ 1, 5, 1
+*End Part
+"""
+
+ASSEMBLY_TEXT = """*Heading
+*Part, name=A
+*Node
+1, 0.0, 0.0, 0.0
+2, 1.0, 0.0, 0.0
+3, 0.0, 1.0, 0.0
+4, 0.0, 0.0, 1.0
+*Element, type=C3D4, elset=TETS
+1, 1, 2, 3, 4
+*Nset, nset=FIX, generate
+1, 3, 2
+*End Part
+*Part, name=B
+*Node
+1, 5.0, 0.0, 0.0
+2, 6.0, 0.0, 0.0
+3, 6.0, 1.0, 0.0
+4, 5.0, 1.0, 0.0
+5, 5.0, 0.0, 1.0
+6, 6.0, 0.0, 1.0
+7, 6.0, 1.0, 1.0
+8, 5.0, 1.0, 1.0
+*Element, type=C3D8
+1, 1, 2, 3, 4, 5, 6, 7, 8
+*Element, type=C3D4
+2, 1, 2, 3, 5
+*End Part
+*Assembly, name=Assembly
+*Instance, name=A-1, part=A
+*End Instance
+*End Assembly
+"""
+
+
+def write_inp(tmp_path, text=INP_TEXT):
+    (tmp_path / 'test.inp').write_text(text, encoding='utf-8')
+    return INPMesh('test', 'test', str(tmp_path))
+
+
+def test_read_inp(tmp_path):
+    mesh = write_inp(tmp_path)
+
+    assert mesh.part_name == 'PART-1'
+    assert mesh.elem_head == '*Element, type=C3D10'
+    assert mesh._inp_head == INP_TEXT.splitlines(keepends=True)[:3]
+    assert mesh._inp_tail == INP_TEXT.splitlines(keepends=True)[-3:]
+    assert mesh.units == 'mm'
+    np.testing.assert_array_equal(mesh.nodes[:, 0], [1, 2, 3, 4, 5])
+    np.testing.assert_array_equal(mesh.nodes[4], [5, 2.0, 2.0, 2.0])
+    assert mesh.elements.shape == (2, 18)
+    np.testing.assert_array_equal(mesh.elements[1, -3:], [4, 5, 1])
+
+
+def test_inp_round_trip(tmp_path):
+    mesh = write_inp(tmp_path)
+    mesh.write_inp(file_name='copy')
+    copy = INPMesh('copy', 'copy', str(tmp_path))
+
+    np.testing.assert_array_equal(copy.nodes, mesh.nodes)
+    np.testing.assert_array_equal(copy.elements, mesh.elements)
+    assert copy._inp_head == mesh._inp_head
+    assert copy._inp_tail == mesh._inp_tail
+
+
+def test_write_inp_split_elements(tmp_path):
+    mesh = write_inp(tmp_path)
+    mesh.write_inp(file_name='split', items_per_line=16)
+    text = (tmp_path / 'split.inp').read_text(encoding='utf-8')
+    copy = INPMesh('split', 'split', str(tmp_path))
+
+    assert text.split('*Element')[1] == INP_TEXT.split('*Element')[1]
+    np.testing.assert_array_equal(copy.elements, mesh.elements)
+
+
+def test_read_assembly(tmp_path):
+    mesh = write_inp(tmp_path, ASSEMBLY_TEXT)
+
+    assert [part.name for part in mesh.parts] == ['A', 'B']
+    assert mesh.nodes.shape == (12, 4)
+    part_a, part_b = mesh.parts
+    assert [s.element_type for s in part_b.element_sections] == ['C3D8', 'C3D4']
+    np.testing.assert_array_equal(part_a.node_sets['FIX'], [1, 3])
+    np.testing.assert_array_equal(part_a.element_sets['TETS'], [1])
+    np.testing.assert_array_equal(mesh.part_nodes('B')[:, 1], [5, 6, 6, 5, 5, 6, 6, 5])
+
+    # The nodes of every part are morphed together and written per section
+    mesh.nodes[:, 1:] += 1.0
+    mesh.write_inp(file_name='moved')
+    moved = INPMesh('moved', 'moved', str(tmp_path))
+    np.testing.assert_array_equal(moved.nodes, mesh.nodes)
+    for section, moved_section in zip(mesh.element_sections, moved.element_sections):
+        assert moved_section.head == section.head
+        np.testing.assert_array_equal(moved_section.elements, section.elements)
+    assert moved._inp_tail == ASSEMBLY_TEXT.splitlines(keepends=True)[-5:]
+
+
+def test_transform_nodes(tmp_path):
+    mesh = write_inp(tmp_path)
+    original = mesh.nodes.copy()
+    t_matrix = tr.transformations.rotation_matrix(0.3, [1, 2, 3], [1, 0, 0])
+    t_matrix[:3, 3] += [1, 2, 3]
+
+    mesh.apply_transformation(t_matrix)
+    expected = [np.dot(t_matrix, np.append(node[1:], 1))[:3] for node in original]
+    np.testing.assert_allclose(mesh.nodes[:, 1:], expected)
+    np.testing.assert_array_equal(mesh.nodes[:, 0], original[:, 0])
+
+    mesh.update_nodes(original[:, 1:])
+    mesh.scale_mesh(0.001)
+    np.testing.assert_allclose(mesh.nodes[:, 1:], original[:, 1:] * 0.001)
+
+    tr.creation.box().export(str(tmp_path / 'box.stl'))
+    box = TriMesh('box', 'box', str(tmp_path))
+    box.apply_transformation(t_matrix)
+    box.scale_mesh(2.0)
+    np.testing.assert_allclose(box.nodes[:, 1:], box.trimesh.vertices)
+    box.update_nodes(box.trimesh.vertices + 1.0)
+    np.testing.assert_allclose(box.nodes[:, 1:], box.trimesh.vertices)
+
+
+def test_order_boundary_loops():
+    rng = np.random.default_rng(0)
+    loop_a = np.c_[np.arange(6), (np.arange(6) + 1) % 6]
+    loop_b = np.c_[np.arange(10, 14), (np.arange(10, 14) - 9) % 4 + 10]
+    edges = np.concatenate([loop_a, loop_b])[rng.permutation(10)]
+    edges[::3] = edges[::3, ::-1]
+
+    loops = order_boundary_loops(edges)
+
+    assert [len(loop) for loop in loops] == [6, 4]
+    for loop, nodes in zip(loops, [range(6), range(10, 14)]):
+        np.testing.assert_array_equal(loop[1:, 0], loop[:-1, 1])
+        assert loop[-1, 1] == loop[0, 0]
+        assert set(loop.ravel()) == set(nodes)
+
+
+def test_boundary_of_tube(tmp_path):
+    box = tr.creation.box()
+    sides = box.faces[np.abs(box.face_normals[:, 2]) < 0.5]
+    tr.Trimesh(box.vertices, sides).export(str(tmp_path / 'tube.stl'))
+    tube = TriMesh('tube', 'tube', str(tmp_path))
+
+    tube.get_boundary()
+
+    assert len(tube.boundary.loops) == 2
+    assert tube.boundary.num_nodes == 4
+    np.testing.assert_array_equal(np.sort(tube.boundary.nodes),
+                                  np.unique(tube.boundary.loops[0]))
+    # Every face of the tube touches the boundary used
+    np.testing.assert_array_equal(tube.boundary.faces, np.arange(8))
+
+
+def test_corners_and_resampling(tmp_path):
+    box = tr.creation.box().subdivide().subdivide()
+    cup = tr.Trimesh(box.vertices, box.faces[box.triangles_center[:, 2] < 0.49])
+    cup.remove_unreferenced_vertices()
+    cup.export(str(tmp_path / 'cup.stl'))
+    mesh = TriMesh('cup', 'cup', str(tmp_path))
+
+    mesh.get_boundary()
+    corners = mesh.trimesh.vertices[mesh.boundary.corner_nodes]
+    np.testing.assert_allclose(np.abs(corners[:, :2]), 0.5)
+
+    coords = mesh.resample_boundary_nodes(8)
+    assert coords.dtype == np.float64 and coords.shape == (8, 3)
+    np.testing.assert_allclose(coords[:, 2], 0.5)
+    # Each side of the rim is split in two between the corners
+    np.testing.assert_allclose(np.linalg.norm(np.diff(coords, axis=0), axis=1), 0.5)
+
+
+def test_bounding_box(tmp_path):
+    mesh = write_inp(tmp_path)
+    centroid, difference, maximums, minimums = mesh.get_bounding_box()
+    assert centroid == [1.0, 1.0, 1.0] and difference == [2.0, 2.0, 2.0]
+    assert maximums == [2.0, 2.0, 2.0] and minimums == [0.0, 0.0, 0.0]
+
+    mesh.scale_mesh(0.1)
+    np.testing.assert_allclose(mesh.bounds, [[0.0] * 3, [0.2] * 3])
+
+    # Units are found from the x range of all the vertices
+    tr.creation.box(extents=[0.5, 4.0, 4.0]).export(str(tmp_path / 'slab.stl'))
+    slab = TriMesh('slab', 'slab', str(tmp_path))
+    assert slab.units == 'm'
+    assert slab.get_bounding_box()[1] == [0.5, 4.0, 4.0]
+    slab.scale_mesh(4.0)
+    assert slab.get_bounding_box()[1] == [2.0, 16.0, 16.0]
+
+
+def test_inp_write_stl(tmp_path):
+    text = INP_TEXT.replace('*Element, type=C3D10', '*Element, type=S3')
+    elements = text[text.index('*Element'):text.index('*Nset')]
+    text = text.replace(elements, '*Element, type=S3\n1, 1, 2, 3\n2, 2, 5, 3\n')
+    mesh = write_inp(tmp_path, text)
+
+    mesh.write_stl()
+    stl = TriMesh('test', 'test', str(tmp_path))
+    np.testing.assert_allclose(stl.trimesh.triangles,
+                               mesh.nodes[mesh.elements[:, 1:] - 1, 1:])
+    np.testing.assert_allclose(mesh.calculate_normals(mesh.nodes[[0, 1, 2]]), [0, 0, 1])
+
+
+def test_inp_write_stl_assembly(tmp_path):
+    text = ASSEMBLY_TEXT.replace('*Element, type=C3D4, elset=TETS\n1, 1, 2, 3, 4',
+                                 '*Element, type=S3, elset=TRIS\n1, 1, 2, 3')
+    text = text.replace('*Element, type=C3D8\n1, 1, 2, 3, 4, 5, 6, 7, 8\n'
+                        '*Element, type=C3D4\n2, 1, 2, 3, 5',
+                        '*Element, type=S3\n1, 1, 2, 3\n2, 1, 3, 4')
+    mesh = write_inp(tmp_path, text)
+    assert len(mesh.element_sections) == 2
+
+    # The node ids of part B are its own, not those of part A
+    mesh.write_stl()
+    stl = tr.load_mesh(str(tmp_path / 'test.stl'), process=False)
+    expected = np.concatenate([mesh.part_nodes('A')[[0, 1, 2], 1:],
+                               mesh.part_nodes('B')[[0, 1, 2, 0, 2, 3], 1:]])
+    np.testing.assert_allclose(stl.triangles.reshape(-1, 3), expected)
+
+
+def test_trimesh_node_view(tmp_path):
+    tr.creation.box().export(str(tmp_path / 'box.stl'))
+    box = TriMesh('box', 'box', str(tmp_path))
+    nodes = box.nodes
+
+    assert nodes.shape == (8, 4)
+    assert np.shares_memory(nodes[:, 1:], box.trimesh.vertices)
+    np.testing.assert_array_equal(nodes[:, 0], np.arange(8))
+    np.testing.assert_array_equal(np.asarray(nodes)[:, 1:], box.trimesh.vertices)
+    np.testing.assert_array_equal(nodes[2], np.r_[2, box.trimesh.vertices[2]])
+
+    nodes[:, 1:] = box.trimesh.vertices * 2.0
+    np.testing.assert_allclose(box.bounds, [[-1.0] * 3, [1.0] * 3])
+
+
+def test_trimesh_node_view_rows(tmp_path):
+    tr.creation.icosphere(4).export(str(tmp_path / 'sphere.stl'))
+    sphere = TriMesh('sphere', 'sphere', str(tmp_path))
+    nodes = sphere.nodes
+    full = np.asarray(nodes)
+
+    rows = list(nodes)
+    assert len(rows) == len(full)
+    np.testing.assert_array_equal(rows[7], full[7])
+    for key in (-1, slice(3, 9), [4, 1], full[:, 3] > 0, (slice(2, 5), slice(0, 2))):
+        np.testing.assert_array_equal(nodes[key], full[key])
+
+    assert nodes.ndim == 2 and nodes.dtype == np.float64
+    copy = nodes.copy()
+    assert not np.shares_memory(copy, sphere.trimesh.vertices)
+    np.testing.assert_array_equal(nodes * 2.0, full * 2.0)
+    np.testing.assert_array_equal(nodes.T, full.T)
+
+
+def test_mesh_container(tmp_path):
+    box = tr.creation.box().subdivide().subdivide()
+    cup = tr.Trimesh(box.vertices, box.faces[box.triangles_center[:, 2] < 0.49])
+    cup.remove_unreferenced_vertices()
+    cup.export(str(tmp_path / 'cup.stl'))
+    mesh = TriMesh('cup', 'cup', str(tmp_path))
+    mesh.get_boundary()
+    mesh.save_mesh_container()
+
+    loaded = TriMesh('cup', 'cup', str(tmp_path), f_type='mesh')
+    np.testing.assert_array_equal(loaded.trimesh.vertices, mesh.trimesh.vertices)
+    np.testing.assert_array_equal(loaded.trimesh.faces, mesh.trimesh.faces)
+    assert loaded.units == mesh.units
+    np.testing.assert_array_equal(loaded.boundary.nodes, mesh.boundary.nodes)
+    assert loaded.boundary.corner_nodes == mesh.boundary.corner_nodes
+    assert loaded.boundary.nodes_sorted
+    assert len(loaded.boundary.loops) == 1
+
+    mesh.save_mesh_container(str(tmp_path / 'small.mesh'), use_float32=True)
+    small = TriMesh('small', 'small', str(tmp_path), load=False)
+    small.load_mesh_container(str(tmp_path / 'small.mesh'), mmap_mode='c')
+    np.testing.assert_allclose(small.trimesh.vertices, mesh.trimesh.vertices)
+    assert (tmp_path / 'small.mesh').stat().st_size < (tmp_path / 'cup.mesh').stat().st_size
+
+
+def test_inp_cache(tmp_path):
+    cache_folder = str(tmp_path / 'cache')
+    (tmp_path / 'test.inp').write_text(INP_TEXT, encoding='utf-8')
+    mesh = INPMesh('test', 'test', str(tmp_path), use_cache=True,
+                   cache_folder=cache_folder)
+    cached = INPMesh('test', 'test', str(tmp_path), use_cache=True,
+                     cache_folder=cache_folder)
+
+    assert isinstance(cached.nodes, np.memmap)
+    np.testing.assert_array_equal(cached.nodes, mesh.nodes)
+    np.testing.assert_array_equal(cached.elements, mesh.elements)
+    assert cached._inp_head == mesh._inp_head
+    assert cached._inp_tail == mesh._inp_tail
+    assert cached.elem_head == mesh.elem_head
+    assert cached.part_name == mesh.part_name
+
+    # Editing the file replaces its entry
+    (tmp_path / 'test.inp').write_text(INP_TEXT.replace('2.0,  2.0,  2.0', '3.0,  3.0,  3.0'))
+    edited = INPMesh('test', 'test', str(tmp_path), use_cache=True,
+                     cache_folder=cache_folder)
+    assert edited.nodes[4, 1] == 3.0
+    assert len(os.listdir(cache_folder)) == 1
+
+
+def test_inp_cache_eviction(tmp_path):
+    cache_folder = tmp_path / 'cache'
+    cache_folder.mkdir()
+    for i in range(3):
+        (cache_folder / f'{i}.inpc').write_bytes(b'\0' * 1024**2)
+        os.utime(cache_folder / f'{i}.inpc', (i, i))
+
+    removed = inp_cache.evict(str(cache_folder), max_size=1.5)
+
+    assert sorted(os.path.basename(path) for path in removed) == ['0.inpc', '1.inpc']
+    assert os.listdir(cache_folder) == ['2.inpc']
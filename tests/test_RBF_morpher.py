@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
+import tracemalloc
 import pytest
 import numpy as np
-from HexMeshMorpher.RBF_morpher import RBFMorpher, custom_RBF
+from scipy import sparse
+from HexMeshMorpher.RBF_morpher import (
+    RBFMorpher, WendlandRBF, MultiquadricRBF, custom_RBF, cubic_RBF,
+    thin_plate_spline_RBF
+)
 from unittest.mock import MagicMock
 
 # test_pytest_unittest.py
@@ -76,3 +81,344 @@ def test_generate_coefficient_matrix():
 
     # Assert that the generated coefficient matrix matches the expected matrix
     np.testing.assert_array_almost_equal(morpher.coeff_matrix, expected_coeff_matrix)
+
+def test_chunked_displacements_match_vectorised():
+    rng = np.random.default_rng(0)
+    original_vertices = rng.random((300, 3)) * 100
+    displaced_vertices = original_vertices + rng.random((300, 3))
+    points = rng.random((1000, 3)) * 100
+
+    morpher = RBFMorpher(original_mesh=MockMesh(original_vertices),
+                         displaced_mesh=MockMesh(displaced_vertices),
+                         RBF=custom_RBF)
+    expected = morpher.calculate_displacements(points)
+
+    # A small memory limit forces the source vertices to be split as well
+    morpher.use_chunked = True
+    morpher.memory_limit = 0.5
+    displacements = morpher.calculate_displacements(points)
+
+    np.testing.assert_allclose(displacements, expected, rtol=1e-9, atol=1e-9)
+    assert 0 < morpher.peak_memory <= 0.5 * 2**20 + displacements.nbytes
+    assert not tracemalloc.is_tracing()
+
+    # Measuring leaves the tracing of a caller alone
+    morpher.trace_memory = True
+    morpher.calculate_displacements(points)
+    assert morpher.peak_memory > 0 and not tracemalloc.is_tracing()
+    tracemalloc.start()
+    try:
+        np.zeros(2**20)
+        morpher.calculate_displacements(points)
+        assert tracemalloc.get_traced_memory()[1] >= 8 * 2**20
+    finally:
+        tracemalloc.stop()
+
+@pytest.mark.parametrize("solver", ["direct", "cg"])
+def test_compact_rbf_sparse_interpolation(solver):
+    rng = np.random.default_rng(1)
+    original_vertices = rng.random((400, 3))
+    displaced_vertices = original_vertices + 0.1 * rng.random((400, 3))
+    RBF = WendlandRBF(support_radius=0.3, smoothness=2)
+
+    morpher = RBFMorpher(original_mesh=MockMesh(original_vertices),
+                         displaced_mesh=MockMesh(displaced_vertices),
+                         RBF=RBF, solver=solver)
+
+    distances = np.linalg.norm(
+        original_vertices[:, np.newaxis] - original_vertices[np.newaxis], axis=2)
+    assert sparse.issparse(morpher.interp_matrix)
+    np.testing.assert_allclose(morpher.interp_matrix.toarray(), RBF(distances))
+
+    # The source vertices must be interpolated exactly
+    np.testing.assert_allclose(morpher.morph_vertices(original_vertices),
+                               displaced_vertices, atol=1e-6)
+
+    points = rng.random((500, 3))
+    distances = np.linalg.norm(
+        points[:, np.newaxis] - original_vertices[np.newaxis], axis=2)
+    np.testing.assert_allclose(morpher.calculate_displacements(points),
+                               RBF(distances) @ morpher.coeff_matrix, atol=1e-12)
+
+def test_select_centres():
+    rng = np.random.default_rng(2)
+    original_vertices = rng.random((600, 3))
+    # A smooth displacement field does not need every vertex as a centre
+    displaced_vertices = original_vertices + 0.05 * np.sin(original_vertices)
+
+    morpher = RBFMorpher(original_mesh=MockMesh(original_vertices),
+                         displaced_mesh=MockMesh(displaced_vertices),
+                         RBF=custom_RBF, centre_tolerance=1e-4)
+
+    assert morpher.n == len(morpher.centre_indices) < 600
+    assert morpher.coeff_matrix.shape == (morpher.n, 3)
+    assert morpher.centre_error <= 1e-4
+    errors = np.linalg.norm(
+        morpher.morph_vertices(original_vertices) - displaced_vertices, axis=1)
+    assert errors.max() <= 1e-4
+
+    # The bordered factorisation gives the same solution as a full solve
+    assert morpher.factor[1] == 'bordered'
+    assert morpher.centre_solve_time > 0.0
+    distances = np.linalg.norm(
+        morpher.centres[:, np.newaxis] - morpher.centres[np.newaxis], axis=2)
+    np.testing.assert_allclose(custom_RBF(distances) @ morpher.coeff_matrix,
+                               morpher.centre_displacements, atol=1e-10)
+
+@pytest.mark.parametrize("RBF", [custom_RBF, WendlandRBF(support_radius=0.4)])
+def test_parallel_displacements_match_vectorised(RBF):
+    rng = np.random.default_rng(3)
+    original_vertices = rng.random((200, 3))
+    displaced_vertices = original_vertices + 0.1 * rng.random((200, 3))
+    points = rng.random((1000, 3))
+
+    morpher = RBFMorpher(original_mesh=MockMesh(original_vertices),
+                         displaced_mesh=MockMesh(displaced_vertices),
+                         RBF=RBF)
+    expected = morpher.calculate_displacements(points)
+
+    morpher.use_multithread = True
+    morpher.processors = 2
+    displacements = morpher.calculate_displacements(points)
+
+    assert displacements.dtype == np.float64
+    np.testing.assert_allclose(displacements, expected, rtol=1e-9, atol=1e-12)
+
+@pytest.mark.parametrize("RBF", [custom_RBF, WendlandRBF(support_radius=0.4)])
+def test_threaded_displacements_match_vectorised(RBF):
+    rng = np.random.default_rng(4)
+    original_vertices = rng.random((200, 3))
+    displaced_vertices = original_vertices + 0.1 * rng.random((200, 3))
+    points = rng.random((1000, 3))
+
+    morpher = RBFMorpher(original_mesh=MockMesh(original_vertices),
+                         displaced_mesh=MockMesh(displaced_vertices),
+                         RBF=RBF)
+    expected = morpher.calculate_displacements(points)
+
+    morpher.execution = 'threads'
+    morpher.threads = 3
+    morpher.memory_limit = 0.1
+    displacements = morpher.calculate_displacements(points)
+
+    np.testing.assert_allclose(displacements, expected, rtol=1e-9, atol=1e-12)
+
+@pytest.mark.parametrize("tolerance", [1e-3, 1e-6])
+def test_treecode_matches_exact_displacements(tolerance):
+    rng = np.random.default_rng(5)
+    original_vertices = rng.random((3000, 3)) * 100
+    coefficients = rng.standard_normal((3000, 3))
+    points = rng.random((2000, 3)) * 100
+
+    morpher = RBFMorpher(custom_RBF)
+    morpher.set_original_mesh(MockMesh(original_vertices))
+    morpher.coeff_matrix = coefficients
+    exact = morpher.calculate_displacements(points)
+
+    morpher.treecode_tolerance = tolerance
+    approximate = morpher.calculate_displacements(points)
+
+    distances = np.linalg.norm(
+        points[:, np.newaxis] - original_vertices[np.newaxis], axis=2)
+    scale = custom_RBF(distances) @ np.abs(coefficients)
+    assert np.all(np.abs(approximate - exact) <= tolerance * scale)
+
+def test_matrix_free_gmres_solver():
+    rng = np.random.default_rng(6)
+    original_vertices = rng.random((1200, 3))
+    displaced_vertices = original_vertices + 0.1 * rng.random((1200, 3))
+
+    direct = RBFMorpher(original_mesh=MockMesh(original_vertices),
+                        displaced_mesh=MockMesh(displaced_vertices),
+                        RBF=custom_RBF)
+    morpher = RBFMorpher(original_mesh=MockMesh(original_vertices),
+                         displaced_mesh=MockMesh(displaced_vertices),
+                         RBF=custom_RBF, solver='gmres')
+
+    assert morpher.interp_matrix is None
+    assert len(morpher.solver_info) == 3
+    for info in morpher.solver_info:
+        assert info['converged']
+        assert info['residual'] < 1e-8
+    np.testing.assert_allclose(morpher.coeff_matrix, direct.coeff_matrix,
+                               rtol=1e-5, atol=1e-6)
+
+@pytest.mark.parametrize("RBF", [custom_RBF, cubic_RBF, thin_plate_spline_RBF,
+                                 MultiquadricRBF(0.5)])
+@pytest.mark.parametrize("solver", ["direct", "gmres"])
+def test_affine_tail_reproduces_rigid_motion(RBF, solver):
+    rng = np.random.default_rng(7)
+    original_vertices = rng.random((300, 3))
+    angle = 0.3
+    rotation = np.array([[np.cos(angle), -np.sin(angle), 0.0],
+                         [np.sin(angle), np.cos(angle), 0.0],
+                         [0.0, 0.0, 1.0]])
+    translation = np.array([0.5, -1.0, 2.0])
+    displaced_vertices = original_vertices @ rotation.T + translation
+
+    morpher = RBFMorpher(original_mesh=MockMesh(original_vertices),
+                         displaced_mesh=MockMesh(displaced_vertices),
+                         RBF=RBF, solver=solver, polynomial_degree=1)
+
+    assert morpher.poly_coeff_matrix.shape == (4, 3)
+    if solver == "direct":
+        # The augmented system is indefinite, so Cholesky is not tried
+        assert morpher.factor[1] == 'ldlt'
+    # The rigid motion is carried by the tail alone
+    np.testing.assert_allclose(morpher.coeff_matrix, 0.0, atol=1e-6)
+    points = rng.random((100, 3)) * 2 - 0.5
+    np.testing.assert_allclose(morpher.morph_vertices(points),
+                               points @ rotation.T + translation, atol=1e-6)
+
+@pytest.mark.parametrize("RBF", [custom_RBF, WendlandRBF(support_radius=0.5)])
+def test_solve_displacement_fields_reuses_factorisation(RBF):
+    rng = np.random.default_rng(8)
+    original_vertices = rng.random((200, 3))
+    targets = [original_vertices + 0.1 * rng.random((200, 3)) for _ in range(3)]
+
+    morpher = RBFMorpher(original_mesh=MockMesh(original_vertices),
+                         displaced_mesh=MockMesh(targets[0]), RBF=RBF,
+                         polynomial_degree=1)
+    factor = morpher.factor
+    results = morpher.solve_displacement_fields([MockMesh(t) for t in targets])
+    assert morpher.factor is factor
+
+    assert len(results) == 3
+    np.testing.assert_allclose(results[0][0], morpher.coeff_matrix, atol=1e-10)
+    for target, (coeffs, poly_coeffs) in zip(targets, results):
+        single = RBFMorpher(original_mesh=MockMesh(original_vertices),
+                            displaced_mesh=MockMesh(target), RBF=RBF,
+                            polynomial_degree=1)
+        np.testing.assert_allclose(coeffs, single.coeff_matrix, atol=1e-8)
+        np.testing.assert_allclose(poly_coeffs, single.poly_coeff_matrix, atol=1e-8)
+
+@pytest.mark.parametrize("RBF", [custom_RBF, WendlandRBF(support_radius=0.5)])
+def test_morph_model_round_trip(tmp_path, RBF):
+    rng = np.random.default_rng(9)
+    original_vertices = rng.random((200, 3))
+    displaced_vertices = original_vertices + 0.1 * rng.random((200, 3))
+    points = rng.random((300, 3))
+
+    morpher = RBFMorpher(original_mesh=MockMesh(original_vertices),
+                         displaced_mesh=MockMesh(displaced_vertices),
+                         RBF=RBF, polynomial_degree=1)
+    file_path = tmp_path / "model.morph"
+    morpher.save_morph_model(file_path)
+
+    loaded = RBFMorpher(custom_RBF)
+    loaded.load_morph_model(file_path, verify=True)
+    assert isinstance(loaded.coeff_matrix, np.memmap)
+    assert type(loaded.RBF) is type(RBF)
+    np.testing.assert_allclose(loaded.morph_vertices(points),
+                               morpher.morph_vertices(points))
+
+    # The stored factorisation (or, for the sparse Wendland matrix, one
+    # generated from the centres) solves new displacement fields directly
+    loaded.set_displaced_mesh(MockMesh(original_vertices * 1.1))
+    loaded.generate_coefficient_matrix()
+    morpher.set_displaced_mesh(MockMesh(original_vertices * 1.1))
+    morpher.generate_coefficient_matrix()
+    np.testing.assert_allclose(loaded.coeff_matrix, morpher.coeff_matrix)
+
+def test_morph_model_round_trip_with_selected_centres(tmp_path):
+    rng = np.random.default_rng(11)
+    original_vertices = rng.random((400, 3))
+    displaced_vertices = original_vertices + 0.05 * np.sin(3 * original_vertices)
+
+    morpher = RBFMorpher(original_mesh=MockMesh(original_vertices),
+                         displaced_mesh=MockMesh(displaced_vertices),
+                         RBF=custom_RBF, centre_tolerance=1e-3)
+    assert morpher.n < 400
+    file_path = tmp_path / "model.morph"
+    morpher.save_morph_model(file_path)
+
+    loaded = RBFMorpher(custom_RBF)
+    loaded.load_morph_model(file_path)
+    np.testing.assert_array_equal(loaded.centre_indices, morpher.centre_indices)
+
+    # The full displaced mesh is solved at the selected centres
+    loaded.set_displaced_mesh(MockMesh(original_vertices * 1.1))
+    loaded.generate_coefficient_matrix()
+    morpher.set_displaced_mesh(MockMesh(original_vertices * 1.1))
+    morpher.generate_coefficient_matrix()
+    np.testing.assert_allclose(loaded.coeff_matrix, morpher.coeff_matrix)
+
+def test_morph_vertices_in_place_and_float32():
+    rng = np.random.default_rng(10)
+    original_vertices = rng.random((300, 3)) * 100
+    displaced_vertices = original_vertices + rng.random((300, 3))
+    nodes = np.column_stack((np.arange(1, 1001), rng.random((1000, 3)) * 100))
+    points = nodes[:, 1:].copy()
+
+    morpher = RBFMorpher(original_mesh=MockMesh(original_vertices),
+                         displaced_mesh=MockMesh(displaced_vertices),
+                         RBF=custom_RBF)
+    expected = morpher.morph_vertices(points)
+
+    # Morph the coordinate columns of a node table in place
+    result = morpher.morph_vertices(nodes[:, 1:], out=nodes[:, 1:])
+    assert np.shares_memory(result, nodes)
+    np.testing.assert_allclose(nodes[:, 1:], expected, rtol=1e-12)
+
+    morpher.use_chunked = True
+    morpher.use_float32 = True
+    approximate = morpher.morph_vertices(points)
+    # Documented bound for the linear RBF (L = 1)
+    u = 2.0**-24
+    centroid = original_vertices.mean(axis=0)
+    R = max(np.linalg.norm(original_vertices - centroid, axis=1).max(),
+            np.linalg.norm(points - centroid, axis=1).max())
+    distances = np.linalg.norm(points[:, np.newaxis] - original_vertices, axis=2)
+    distance_error = np.minimum(np.sqrt(6*u) * R, 3*u*R**2 / distances)
+    weights = np.abs(morpher.coeff_matrix).sum(axis=1)
+    bound = (distance_error + 300*u*distances) @ weights
+    assert np.all(np.abs(approximate - expected).max(axis=1) <= bound)
+
+def test_threaded_displacements_limit_blas_threads(monkeypatch):
+    threadpoolctl = pytest.importorskip("threadpoolctl")
+    from HexMeshMorpher import RBF_morpher
+    rng = np.random.default_rng(5)
+    original_vertices = rng.random((100, 3))
+    displaced_vertices = original_vertices + 0.1 * rng.random((100, 3))
+
+    morpher = RBFMorpher(original_mesh=MockMesh(original_vertices),
+                         displaced_mesh=MockMesh(displaced_vertices),
+                         RBF=custom_RBF, execution='threads', threads=3,
+                         blas_threads=2)
+    morpher.memory_limit = 0.1
+
+    # Record the BLAS threads seen by each task
+    seen = []
+    evaluate_dense = RBF_morpher._evaluate_dense
+
+    def recording_evaluate_dense(*args, **kwargs):
+        seen.extend(info['num_threads'] for info in threadpoolctl.threadpool_info()
+                    if info['user_api'] == 'blas')
+        return evaluate_dense(*args, **kwargs)
+
+    monkeypatch.setattr(RBF_morpher, '_evaluate_dense', recording_evaluate_dense)
+    with threadpoolctl.threadpool_limits(limits=4, user_api='blas'):
+        morpher.calculate_displacements(rng.random((500, 3)))
+        assert seen and all(threads == 2 for threads in seen)
+        # The limit is lifted again after the evaluation
+        assert all(info['num_threads'] == 4 for info in threadpoolctl.threadpool_info()
+                   if info['user_api'] == 'blas')
+
+def test_gmres_solver_with_treecode_matvec():
+    rng = np.random.default_rng(8)
+    original_vertices = rng.random((2000, 3))
+    displaced_vertices = original_vertices + 0.1 * rng.random((2000, 3))
+
+    direct = RBFMorpher(original_mesh=MockMesh(original_vertices),
+                        displaced_mesh=MockMesh(displaced_vertices),
+                        RBF=custom_RBF)
+    morpher = RBFMorpher(original_mesh=MockMesh(original_vertices),
+                         displaced_mesh=MockMesh(displaced_vertices),
+                         RBF=custom_RBF, solver='gmres', treecode_tolerance=1e-5)
+
+    # The three components are solved together
+    assert len({info['time_per_iteration'] for info in morpher.solver_info}) == 1
+    for info in morpher.solver_info:
+        assert info['converged']
+    # The far field of the treecode is only accurate to its tolerance
+    np.testing.assert_allclose(morpher.coeff_matrix, direct.coeff_matrix, atol=1e-2)
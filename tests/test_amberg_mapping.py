@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import pytest
+import numpy as np
+import trimesh as tr
+from HexMeshMorpher.MeshObj import TriMesh
+from HexMeshMorpher.amberg_mapping import AmbergMapping
+from HexMeshMorpher.nricp import TargetIndex, nricp_amberg
+
+STEPS = [[0.01, 10, 0.5, 5], [0.02, 5, 0.5, 5], [0.01, 0, 0.0, 5]]
+
+
+def make_meshes():
+    source = tr.creation.icosphere(2)
+    target = tr.creation.icosphere(3)
+    target.vertices = target.vertices * [1.2, 0.9, 1.0] + 0.05
+    return source, target
+
+
+@pytest.mark.parametrize("solver", ['direct', 'cg'])
+def test_nricp_amberg_matches_trimesh(solver):
+    source, target = make_meshes()
+    landmarks = [0, 5, 10]
+    positions = target.vertices[landmarks]
+    # trimesh normalises the meshes in place, so give it copies
+    reference = tr.registration.nricp_amberg(source.copy(), target.copy(),
+                                             source_landmarks=landmarks,
+                                             target_positions=positions,
+                                             steps=STEPS, eps=0.001, use_faces=False)
+
+    index = TargetIndex(target)
+    mapped = nricp_amberg(source, index, landmarks, positions, steps=STEPS, eps=0.001,
+                          solver=solver)
+
+    np.testing.assert_allclose(mapped, reference, atol=1e-6)
+    assert index.query_count > 0
+
+
+def test_target_index_reused(tmp_path):
+    source, target = make_meshes()
+    source.export(str(tmp_path / 'source.stl'))
+    target.export(str(tmp_path / 'target.stl'))
+    source = TriMesh('source', 'source', str(tmp_path))
+    target = TriMesh('target', 'target', str(tmp_path))
+
+    first = AmbergMapping(source, target, TriMesh('a', 'a', str(tmp_path), load=False), steps=STEPS)
+    second = AmbergMapping(source, target, TriMesh('b', 'b', str(tmp_path), load=False), steps=STEPS)
+    assert second.target_index is first.target_index
+    assert second.timings['index_build'] == 0.0
+    np.testing.assert_allclose(first.mapped.trimesh.vertices, second.mapped.trimesh.vertices)
+
+    # Moving the target makes the kept index out of date
+    target.scale_mesh(2.0)
+    third = AmbergMapping(source, target, TriMesh('c', 'c', str(tmp_path), load=False), steps=STEPS)
+    assert third.target_index is not first.target_index
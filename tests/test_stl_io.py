@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import pytest
+import numpy as np
+import trimesh as tr
+from HexMeshMorpher import stl_io
+
+
+@pytest.mark.parametrize("binary", [True, False])
+def test_stl_round_trip(tmp_path, binary):
+    mesh = tr.creation.icosphere(2)
+    file_path = str(tmp_path / 'sphere.stl')
+    stl_io.write_stl(file_path, mesh.triangles, binary=binary, name='sphere')
+
+    assert stl_io.is_binary(file_path) == binary
+    with open(file_path, 'rb') as file:
+        header = file.read(80)
+    assert header.startswith(b'solid') != binary
+    loaded = stl_io.load_stl(file_path)
+    assert loaded.vertices.shape == mesh.vertices.shape
+    np.testing.assert_allclose(loaded.triangles, mesh.triangles, atol=1e-6)
+    # trimesh reads the same file the same way
+    reference = tr.load_mesh(file_path)
+    np.testing.assert_allclose(loaded.volume, reference.volume)
+    np.testing.assert_allclose(stl_io.face_normals(loaded.triangles),
+                               reference.face_normals, atol=1e-6)
+
+
+def test_merge_vertices():
+    triangles = np.array([
+        [[0, 0, 0], [1, 0, 0], [0, 1, 0]],
+        [[1, 0, 0], [1, 1, -0.0], [0, 1, 0]],
+        ], dtype=np.float64)
+
+    vertices, faces = stl_io.merge_vertices(triangles)
+
+    np.testing.assert_array_equal(vertices, [[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0]])
+    np.testing.assert_array_equal(faces, [[0, 1, 2], [1, 3, 2]])